@@ -100,6 +100,12 @@ class SimulateServer:
                 {
                     "time": sim_time,
                     "step": i + 1,
+                    # LLM调用统计（累计值），用于分析各prompt的耗时与token开销
+                    "llm": {
+                        n: a._llm.get_summary()
+                        for n, a in self.game.agents.items()
+                        if a.llm_available()
+                    },
                 }
             )
             # 保存Agent活动数据
@@ -153,6 +159,7 @@ def get_config(start_time="20240213-09:30", stride=15, agents=None):
     config = {
         "stride": stride,
         "time": {"start": start_time},
+        "retry_budget": json_data.get("retry_budget", -1),
         "maze": {"path": os.path.join(assets_root, "maze.json")},
         "agent_base": agent_config,
         "agents": {},
@@ -6,7 +6,7 @@ import random
 import datetime
 
 from modules import memory, prompt, utils
-from modules.model.llm_model import create_llm_model
+from modules.model.router import create_llm_router
 from modules.memory.associate import Concept
 
 
@@ -87,28 +87,46 @@ class Agent:
 
     def reset(self):
         if not self._llm:
-            self._llm = create_llm_model(self.think_config["llm"])
+            self._llm = create_llm_router(self.think_config)
 
     def completion(self, func_hint, *args, **kwargs):
+        prompt = self._build_prompt(func_hint, *args, **kwargs)
+        if self.llm_available():
+            self.logger.info("{} -> {}".format(self.name, func_hint))
+            output = self._llm.completion(**prompt, caller=func_hint)
+        else:
+            output = prompt.get("failsafe")
+        return self._log_completion(func_hint, prompt, output)
+
+    async def acompletion(self, func_hint, *args, **kwargs):
+        prompt = self._build_prompt(func_hint, *args, **kwargs)
+        if self.llm_available():
+            self.logger.info("{} -> {} (async)".format(self.name, func_hint))
+            output = await self._llm.acompletion(**prompt, caller=func_hint)
+        else:
+            output = prompt.get("failsafe")
+        return self._log_completion(func_hint, prompt, output)
+
+    def _build_prompt(self, func_hint, *args, **kwargs):
         assert hasattr(
             self.scratch, "prompt_" + func_hint
         ), "Can not find func prompt_{} from scratch".format(func_hint)
         func = getattr(self.scratch, "prompt_" + func_hint)
-        prompt = func(*args, **kwargs)
+        return func(*args, **kwargs)
+
+    def _log_completion(self, func_hint, prompt, output):
         title, msg = "{}.{}".format(self.name, func_hint), {}
         if self.llm_available():
-            self.logger.info("{} -> {}".format(self.name, func_hint))
-            output = self._llm.completion(**prompt, caller=func_hint)
             responses = self._llm.meta_responses
             msg = {"<PROMPT>": "\n" + prompt["prompt"] + "\n"}
+            if prompt.get("system"):
+                msg = {"<SYSTEM>": "\n" + prompt["system"] + "\n", **msg}
             msg.update(
                 {
                     "<RESPONSE[{}/{}]>".format(idx+1, len(responses)): "\n" + r + "\n"
                     for idx, r in enumerate(responses)
                 }
             )
-        else:
-            output = prompt.get("failsafe")
         msg["<OUTPUT>"] = "\n" + str(output) + "\n"
         self.logger.debug(utils.block_msg(title, msg))
         return output
@@ -294,26 +312,33 @@ class Agent:
                     events[event] = dist
         events = list(sorted(events.keys(), key=lambda k: events[k]))
         # get concepts
-        self.concepts, valid_num = [], 0
+        self.concepts, pending = [], []
+        recent_nodes = (
+            self.associate.retrieve_events() + self.associate.retrieve_chats()
+        )
+        recent_nodes = set(n.describe for n in recent_nodes)
         for idx, event in enumerate(events[: self.percept_config["att_bandwidth"]]):
-            recent_nodes = (
-                self.associate.retrieve_events() + self.associate.retrieve_chats()
-            )
-            recent_nodes = set(n.describe for n in recent_nodes)
-            if event.get_describe() not in recent_nodes:
-                if event.object == "idle" or event.object == "空闲":
-                    node = Concept.from_event(
-                        "idle_" + str(idx), "event", event, poignancy=1
-                    )
-                else:
-                    valid_num += 1
-                    node_type = "chat" if event.fit(self.name, "对话") else "event"
-                    node = self._add_concept(node_type, event)
-                    self.status["poignancy"] += node.poignancy
+            if event.get_describe() in recent_nodes:
+                continue
+            if event.object == "idle" or event.object == "空闲":
+                node = Concept.from_event(
+                    "idle_" + str(idx), "event", event, poignancy=1
+                )
                 self.concepts.append(node)
+            else:
+                # 与逐条写入记忆时一致：只有写入记忆的事件参与后续去重
+                recent_nodes.add(event.get_describe())
+                node_type = "chat" if event.fit(self.name, "对话") else "event"
+                pending.append((len(self.concepts), node_type, event))
+                self.concepts.append(None)
+        # score all new concepts in one round-trip, keep the percept order
+        nodes = self._add_concepts([(t, e) for _, t, e in pending])
+        for (pos, _, _), node in zip(pending, nodes):
+            self.status["poignancy"] += node.poignancy
+            self.concepts[pos] = node
         self.concepts = [c for c in self.concepts if c.event.subject != self.name]
         self.logger.info(
-            "{} percept {}/{} concepts".format(self.name, valid_num, len(self.concepts))
+            "{} percept {}/{} concepts".format(self.name, len(pending), len(self.concepts))
         )
 
     def make_plan(self, agents):
@@ -699,14 +724,9 @@ class Agent:
         expire=None,
         filling=None,
     ):
-        if event.fit(None, "is", "idle"):
-            poignancy = 1
-        elif event.fit(None, "此时", "空闲"):
-            poignancy = 1
-        elif e_type == "chat":
-            poignancy = self.completion("poignancy_chat", event)
-        else:
-            poignancy = self.completion("poignancy_event", event)
+        poignancy = self._fixed_poignancy(event)
+        if poignancy is None:
+            poignancy = self.completion(self._poignancy_func(e_type), event)
         self.logger.debug("{} add associate {}".format(self.name, event))
         return self.associate.add_node(
             e_type,
@@ -717,6 +737,33 @@ class Agent:
             filling=filling,
         )
 
+    def _add_concepts(self, items):
+        poignancies = [self._fixed_poignancy(event) for _, event in items]
+        batch = [idx for idx, p in enumerate(poignancies) if p is None]
+        if len(batch) == 1:
+            e_type, event = items[batch[0]]
+            poignancies[batch[0]] = self.completion(self._poignancy_func(e_type), event)
+        elif batch:
+            scores = self.completion("poignancy_batch", [items[i] for i in batch])
+            for idx, score in zip(batch, scores):
+                poignancies[idx] = score
+        nodes = []
+        for (e_type, event), poignancy in zip(items, poignancies):
+            self.logger.debug("{} add associate {}".format(self.name, event))
+            nodes.append(self.associate.add_node(e_type, event, poignancy))
+        return nodes
+
+    def _poignancy_func(self, e_type):
+        # 只有对话使用单独的打分提示，其余节点（event、thought等）按事件打分
+        return "poignancy_chat" if e_type == "chat" else "poignancy_event"
+
+    def _fixed_poignancy(self, event):
+        if event.fit(None, "is", "idle"):
+            return 1
+        if event.fit(None, "此时", "空闲"):
+            return 1
+        return None
+
     def get_tile(self):
         return self.maze.tile_at(self.coord)
 
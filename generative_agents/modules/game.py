@@ -91,6 +91,7 @@ def create_game(name, static_root, config, conversation, logger=None):
     """Create the game"""
 
     utils.set_timer(**config.get("time", {}))
+    utils.set_retry_budget(config.get("retry_budget", -1))
     GenerativeAgentsMap.set(GenerativeAgentsKey.GAME, Game(name, static_root, config, conversation, logger=logger))
     return GenerativeAgentsMap.get(GenerativeAgentsKey.GAME)
 
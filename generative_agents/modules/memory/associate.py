@@ -1,11 +1,9 @@
 """generative_agents.memory.associate"""
 
 import datetime
-from llama_index.core.retrievers import BaseRetriever
 from llama_index.core.vector_stores import MetadataFilters, ExactMatchFilter
-from llama_index.core.indices.vector_store.retrievers import VectorIndexRetriever
 
-from modules.storage.index import LlamaIndex
+from modules.storage.index import create_index
 from modules import utils
 from .event import Event
 
@@ -73,51 +71,45 @@ class Concept:
         )
 
 
-class AssociateRetriever(BaseRetriever):
-    def __init__(self, config, *args, **kwargs) -> None:
-        self._config = config
-        self._vector_retriever = VectorIndexRetriever(*args, **kwargs)
-        super().__init__()
+def rerank_nodes(config, nodes):
+    """Re-rank retrieved nodes by recency, relevance and importance"""
 
-    def _retrieve(self, query_bundle):
-        """Retrieve nodes given query."""
-
-        nodes = self._vector_retriever.retrieve(query_bundle)
-        if not nodes:
-            return []
-        nodes = sorted(
-            nodes, key=lambda n: utils.to_date(n.metadata["access"]), reverse=True
-        )
-        # get scores
-        fac = self._config["recency_decay"]
-        recency_scores = self._normalize(
-            [fac**i for i in range(1, len(nodes) + 1)], self._config["recency_weight"]
-        )
-        relevance_scores = self._normalize(
-            [n.score for n in nodes], self._config["relevance_weight"]
+    if not nodes:
+        return []
+    nodes = sorted(
+        nodes, key=lambda n: utils.to_date(n.metadata["access"]), reverse=True
+    )
+    # get scores
+    fac = config["recency_decay"]
+    recency_scores = _normalize(
+        [fac**i for i in range(1, len(nodes) + 1)], config["recency_weight"]
+    )
+    relevance_scores = _normalize(
+        [n.score for n in nodes], config["relevance_weight"]
+    )
+    importance_scores = _normalize(
+        [n.metadata["poignancy"] for n in nodes], config["importance_weight"]
+    )
+    final_scores = {
+        n.id_: r1 + r2 + i
+        for n, r1, r2, i in zip(
+            nodes, recency_scores, relevance_scores, importance_scores
         )
-        importance_scores = self._normalize(
-            [n.metadata["poignancy"] for n in nodes], self._config["importance_weight"]
-        )
-        final_scores = {
-            n.id_: r1 + r2 + i
-            for n, r1, r2, i in zip(
-                nodes, recency_scores, relevance_scores, importance_scores
-            )
-        }
-        # re-rank nodes
-        nodes = sorted(nodes, key=lambda n: final_scores[n.id_], reverse=True)
-        nodes = nodes[: self._config["retrieve_max"]]
-        for n in nodes:
-            n.metadata["access"] = utils.get_timer().get_date("%Y%m%d-%H:%M:%S")
-        return nodes
+    }
+    # re-rank nodes
+    nodes = sorted(nodes, key=lambda n: final_scores[n.id_], reverse=True)
+    nodes = nodes[: config["retrieve_max"]]
+    for n in nodes:
+        n.metadata["access"] = utils.get_timer().get_date("%Y%m%d-%H:%M:%S")
+    return nodes
+
 
-    def _normalize(self, data, factor=1, t_min=0, t_max=1):
-        min_val, max_val = min(data), max(data)
-        diff = max_val - min_val
-        if diff == 0:
-            return [(t_max - t_min) * factor / 2 for _ in data]
-        return [(d - min_val) * (t_max - t_min) * factor / diff + t_min for d in data]
+def _normalize(data, factor=1, t_min=0, t_max=1):
+    min_val, max_val = min(data), max(data)
+    diff = max_val - min_val
+    if diff == 0:
+        return [(t_max - t_min) * factor / 2 for _ in data]
+    return [(d - min_val) * (t_max - t_min) * factor / diff + t_min for d in data]
 
 
 class Associate:
@@ -132,10 +124,13 @@ class Associate:
         recency_weight=0.5,
         relevance_weight=3,
         importance_weight=2,
+        vector_store="llama_index",
         memory=None,
     ):
-        self._index = LlamaIndex(embedding, path)
+        self._index = create_index(embedding, path, vector_store)
         self.memory = memory or {"event": [], "thought": [], "chat": []}
+        # 记忆代数：每次增删节点后递增，用于让检索缓存失效
+        self.generation = 0
         self.cleanup_index()
         self.retention = retention
         self.max_memory = max_memory
@@ -162,6 +157,7 @@ class Associate:
             n_type: [n for n in nodes if n not in node_ids]
             for n_type, nodes in self.memory.items()
         }
+        self.generation += 1
 
     def add_node(
         self,
@@ -191,6 +187,7 @@ class Associate:
         if len(memory) >= self.max_memory > 0:
             self._index.remove_nodes(memory[self.max_memory:])
             self.memory[node_type] = memory[: self.max_memory - 1]
+        self.generation += 1
         return self.to_concept(node)
 
     def to_concept(self, node):
@@ -222,18 +219,16 @@ class Associate:
         return self._retrieve_nodes("chat", text)
 
     def retrieve_focus(self, focus, retrieve_max=30, reduce_all=True):
-        def _create_retriever(*args, **kwargs):
-            self._retrieve_config["retrieve_max"] = retrieve_max
-            return AssociateRetriever(self._retrieve_config, *args, **kwargs)
-
+        self._retrieve_config["retrieve_max"] = retrieve_max
         retrieved = {}
         node_ids = self.memory["event"] + self.memory["thought"]
         for text in focus:
-            nodes = self._index.retrieve(
-                text,
-                similarity_top_k=len(node_ids),
-                node_ids=node_ids,
-                retriever_creator=_create_retriever,
+            # 先按相似度取出全部候选，再按时间、相关性和重要性重排
+            nodes = rerank_nodes(
+                self._retrieve_config,
+                self._index.retrieve(
+                    text, similarity_top_k=len(node_ids), node_ids=node_ids
+                ),
             )
             if reduce_all:
                 retrieved.update({n.id_: n for n in nodes})
@@ -1,3 +1,4 @@
 """generative_agents.model"""
 
 from .llm_model import *
+from .router import *
@@ -0,0 +1,175 @@
+"""generative_agents.model.balancer"""
+
+import time
+import threading
+import contextlib
+
+from modules import utils
+from .transport import get_transport
+
+# 进程级注册表：同一组 endpoints 的负载在所有 Agent 之间共享
+_balancers = {}
+_balancers_lock = threading.Lock()
+
+
+class Endpoint:
+    """One backend url with its own transport, breaker and load counter"""
+
+    def __init__(self, provider, base_url, api_key, weight, transport, breaker):
+        self.provider = provider
+        self.base_url = base_url
+        self.api_key = api_key
+        self.weight = max(weight, 0.01)
+        self.transport = transport
+        self.breaker = breaker
+        self.outstanding = 0
+        self.dispatched = 0
+        # /models 探测的结果，与请求的熔断器分开记录
+        self.probe_ok = True
+        self._lock = threading.Lock()
+
+    @property
+    def load(self):
+        return self.outstanding / self.weight
+
+    @property
+    def share(self):
+        return self.dispatched / self.weight
+
+    @property
+    def healthy(self):
+        return self.probe_ok and not self.breaker.is_open
+
+    @contextlib.contextmanager
+    def track(self):
+        with self._lock:
+            self.outstanding += 1
+            self.dispatched += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self.outstanding -= 1
+
+    def probe(self, timeout=5):
+        """Cheap health check on /models"""
+
+        headers = {"Authorization": "Bearer " + self.api_key} if self.api_key else {}
+        try:
+            response = self.transport.session().get(
+                f"{self.base_url}/models", headers=headers, timeout=timeout
+            )
+            return response.status_code < 500
+        except Exception:
+            return False
+
+    def abstract(self):
+        return {
+            "weight": self.weight,
+            "outstanding": self.outstanding,
+            "dispatched": self.dispatched,
+            "healthy": self.healthy,
+            "probe_ok": self.probe_ok,
+        }
+
+
+class EndpointBalancer:
+    """Least-outstanding-requests dispatch over weighted endpoints
+
+    Ties in outstanding requests (always the case for synchronous calls) are broken
+    by dispatched / weight, so new callers are spread over the endpoints by weight.
+    Endpoints are ejected while their circuit breaker is open or, with several
+    endpoints, while the /models probe fails; the probe never trips the breaker. Callers pass their previous endpoint to stay sticky,
+    which keeps the server side prompt cache of that endpoint warm.
+    """
+
+    def __init__(
+        self,
+        endpoints,
+        sticky_slack=2,
+        health_interval=15,
+        probe_timeout=5,
+    ):
+        self.endpoints = endpoints
+        self.sticky_slack = sticky_slack
+        self.health_interval = health_interval
+        self.probe_timeout = probe_timeout
+        self._lock = threading.Lock()
+        self._health_thread = None
+        # 只有一个节点时无从选择，不探测（避免带着 api key 反复请求远端 /models）
+        probed = [e for e in endpoints if e.base_url]
+        if health_interval > 0 and len(endpoints) > 1 and probed:
+            self._health_thread = threading.Thread(target=self._health_loop, daemon=True)
+            self._health_thread.start()
+
+    def pick(self, sticky=None):
+        """Pick an endpoint, None if all of them are ejected"""
+
+        with self._lock:
+            candidates = [e for e in self.endpoints if e.healthy]
+            if not candidates:
+                # 全部被摘除时，允许冷却结束的节点半开试探
+                candidates = [e for e in self.endpoints if e.breaker.allow()]
+            if not candidates:
+                return None
+            best = min(candidates, key=lambda e: (e.load, e.share))
+            if sticky in candidates and sticky.load <= best.load + self.sticky_slack:
+                return sticky
+            return best
+
+    def _health_loop(self):
+        while True:
+            time.sleep(self.health_interval)
+            for endpoint in self.endpoints:
+                if not endpoint.base_url:
+                    continue
+                probe_ok = endpoint.probe(self.probe_timeout)
+                if probe_ok != endpoint.probe_ok:
+                    state = "is back" if probe_ok else "failed the health probe"
+                    print(f"EndpointBalancer: {endpoint.base_url} {state}")
+                endpoint.probe_ok = probe_ok
+
+    def abstract(self):
+        return {str(e.base_url): e.abstract() for e in self.endpoints}
+
+
+def _endpoint_configs(llm_config):
+    endpoints = llm_config.get("endpoints")
+    if not endpoints:
+        return [{"base_url": llm_config.get("base_url")}]
+    return [{"base_url": e} if isinstance(e, str) else e for e in endpoints]
+
+
+def get_balancer(llm_config):
+    """Get the shared balancer of the endpoints in llm config, create it if needed"""
+
+    provider = llm_config["provider"]
+    configs = _endpoint_configs(llm_config)
+    key = tuple(
+        (provider, c.get("base_url"), c.get("api_key", llm_config.get("api_key")))
+        for c in configs
+    )
+    with _balancers_lock:
+        if key not in _balancers:
+            policy = utils.RetryPolicy(**llm_config.get("retry", {}))
+            endpoints = []
+            for config in configs:
+                api_key = config.get("api_key", llm_config.get("api_key"))
+                endpoint_config = {
+                    "provider": provider,
+                    "base_url": config.get("base_url"),
+                    "api_key": api_key,
+                    "transport": llm_config.get("transport", {}),
+                }
+                endpoints.append(
+                    Endpoint(
+                        provider,
+                        config.get("base_url"),
+                        api_key,
+                        config.get("weight", 1),
+                        get_transport(endpoint_config),
+                        policy.breaker(config.get("base_url") or provider),
+                    )
+                )
+            _balancers[key] = EndpointBalancer(endpoints, **llm_config.get("balancer", {}))
+        return _balancers[key]
@@ -0,0 +1,109 @@
+"""generative_agents.model.cache"""
+
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+
+# 按数据库路径共享缓存实例，所有 Agent 共用同一个连接
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class CompletionCache:
+    """Persistent prompt -> response cache backed by a local SQLite file
+
+    Only raw responses are stored, callers re-run their callback on a hit so the
+    cached entry never holds parsed objects.
+    """
+
+    def __init__(
+        self,
+        path="results/llm_cache.db",
+        ttl=0,
+        max_entries=20000,
+        default=False,
+        callers=None,
+        **kwargs
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._default = default
+        self._callers = callers or {}
+        self._lock = threading.Lock()
+
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS completion ("
+                "key TEXT PRIMARY KEY, caller TEXT, response TEXT, "
+                "created REAL, accessed REAL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS completion_accessed ON completion(accessed)"
+            )
+
+    def enabled(self, caller):
+        return self._callers.get(caller, self._default)
+
+    @staticmethod
+    def make_key(model, prompt, sampling, caller):
+        raw = json.dumps([model, prompt, sampling, caller], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created FROM completion WHERE key = ?", (key,)
+            ).fetchone()
+            if not row:
+                return None
+            response, created = row
+            with self._conn:
+                if self.ttl > 0 and created + self.ttl < now:
+                    self._conn.execute("DELETE FROM completion WHERE key = ?", (key,))
+                    return None
+                self._conn.execute(
+                    "UPDATE completion SET accessed = ? WHERE key = ?", (now, key)
+                )
+        return response
+
+    def put(self, key, caller, response):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO completion VALUES (?, ?, ?, ?, ?)",
+                (key, caller, response, now, now),
+            )
+            if self.max_entries > 0:
+                # LRU: 超出容量时淘汰最久未访问的条目
+                self._conn.execute(
+                    "DELETE FROM completion WHERE key IN ("
+                    "SELECT key FROM completion ORDER BY accessed DESC "
+                    "LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+
+    @property
+    def size(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM completion").fetchone()[0]
+
+
+def get_completion_cache(cache_config):
+    """Get the shared completion cache, None if the cache is not enabled"""
+
+    if not cache_config or not cache_config.get("enable", False):
+        return None
+    path = cache_config.get("path", "results/llm_cache.db")
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = CompletionCache(**cache_config)
+        return _caches[path]
@@ -2,16 +2,39 @@
 
 import time
 import re
-import requests
+import json
+import asyncio
+import functools
+
+from modules import utils
+from .stream import JsonStreamScanner
+from .balancer import get_balancer
+from .cache import get_completion_cache
+from .telemetry import Telemetry, estimate_tokens
 
 
 class LLMModel:
     def __init__(self, config):
-        self._api_key = config["api_key"]
-        self._base_url = config["base_url"]
+        self._api_key = config.get("api_key")
+        self._base_url = config.get("base_url")
         self._model = config["model"]
         self._meta_responses = []
+        self._failed = False
         self._summary = {"total": [0, 0, 0]}
+        self._balancer = get_balancer(config)
+        # 每个 Agent 持有自己的 LLMModel，记住上次的 endpoint 以保持粘性路由
+        self._endpoint = None
+        self._cache = get_completion_cache(config.get("cache"))
+        self._cache_summary = {}
+        self._telemetry = Telemetry()
+        self._stream = config.get("stream", True)
+        # json_schema| json_object| false, downgraded when the backend rejects it
+        self._structured = config.get("structured_output", "json_schema")
+        # 生成参数档位：prompt 声明 profile，config 可以按 caller 覆盖
+        generation = config.get("generation", {})
+        self._profiles = generation.get("profiles", {})
+        self._caller_profiles = generation.get("callers", {})
+        self._retry_policy = utils.RetryPolicy(**config.get("retry", {}))
 
         self._handle = self.setup(config)
         self._enabled = True
@@ -24,31 +47,257 @@ class LLMModel:
     def completion(
         self,
         prompt,
-        retry=10,
+        retry=None,
         callback=None,
         failsafe=None,
         caller="llm_normal",
         **kwargs
     ):
-        response, self._meta_responses = None, []
+        response, meta_responses = None, []
         self._summary.setdefault(caller, [0, 0, 0])
-        for _ in range(retry):
+        kwargs = self._generation_params(caller, kwargs)
+        text = self._full_prompt(prompt, kwargs.get("system"))
+        cache_key, cached = self._cache_lookup(text, callback, caller, **kwargs)
+        if cached is not None:
+            return self._finish(cached, meta_responses, failsafe, caller)
+        retry = retry or self._retry_policy.max_retry
+        start, usages = time.time(), []
+        for attempt in range(retry):
+            endpoint = self._route()
+            if not endpoint:
+                print(f"LLMModel.completion() circuit open for all endpoints")
+                break
+            breaker = endpoint.breaker
+            usage = {}
+            usages.append(usage)
             try:
-                meta_response = self._completion(prompt, **kwargs).strip()
-                self._meta_responses.append(meta_response)
-                self._summary["total"][0] += 1
-                self._summary[caller][0] += 1
-                if callback:
-                    response = callback(meta_response)
-                else:
-                    response = meta_response
+                with endpoint.track():
+                    meta_response = self._completion(prompt, endpoint=endpoint, usage=usage, **kwargs).strip()
+                breaker.success()
+                self._fill_usage(usage, text, meta_response)
             except Exception as e:
-                print(f"LLMModel.completion() caused an error: {e}")
-                time.sleep(5)
-                response = None
+                if self._downgrade_structured(e, kwargs.get("schema")):
+                    continue
+                delay = self._on_request_error("completion", e, breaker, attempt, retry)
+                if delay is None:
+                    break
+                time.sleep(delay)
+                continue
+            response = self._on_response(
+                "completion", meta_response, meta_responses, callback, caller
+            )
+            if response is not None:
+                break
+            if not self._retry_policy.allow_retry(attempt, retry):
+                break
+        self._record_telemetry(caller, text, start, usages)
+        self._cache_store(cache_key, response, meta_responses, failsafe, caller)
+        return self._finish(response, meta_responses, failsafe, caller)
+
+    async def acompletion(
+        self,
+        prompt,
+        retry=None,
+        callback=None,
+        failsafe=None,
+        caller="llm_normal",
+        **kwargs
+    ):
+        """Async counterpart of completion, independent calls can overlap on one loop"""
+
+        response, meta_responses = None, []
+        self._summary.setdefault(caller, [0, 0, 0])
+        kwargs = self._generation_params(caller, kwargs)
+        text = self._full_prompt(prompt, kwargs.get("system"))
+        cache_key, cached = self._cache_lookup(text, callback, caller, **kwargs)
+        if cached is not None:
+            return self._finish(cached, meta_responses, failsafe, caller)
+        retry = retry or self._retry_policy.max_retry
+        start, usages = time.time(), []
+        for attempt in range(retry):
+            endpoint = self._route()
+            if not endpoint:
+                print(f"LLMModel.acompletion() circuit open for all endpoints")
+                break
+            breaker = endpoint.breaker
+            usage = {}
+            usages.append(usage)
+            try:
+                with endpoint.track():
+                    meta_response = (
+                        await self._acompletion(
+                            prompt, endpoint=endpoint, usage=usage, **kwargs
+                        )
+                    ).strip()
+                breaker.success()
+                self._fill_usage(usage, text, meta_response)
+            except Exception as e:
+                if self._downgrade_structured(e, kwargs.get("schema")):
+                    continue
+                delay = self._on_request_error("acompletion", e, breaker, attempt, retry)
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
                 continue
+            response = self._on_response(
+                "acompletion", meta_response, meta_responses, callback, caller
+            )
             if response is not None:
                 break
+            if not self._retry_policy.allow_retry(attempt, retry):
+                break
+        self._record_telemetry(caller, text, start, usages)
+        self._cache_store(cache_key, response, meta_responses, failsafe, caller)
+        return self._finish(response, meta_responses, failsafe, caller)
+
+    def _generation_params(self, caller, kwargs):
+        """Merge max_tokens/stop/temperature/top_p of the generation profile
+
+        The profile declared by the prompt is the base, explicit kwargs override it
+        and the caller entry of config overrides both. A caller entry is either a
+        profile name or a dict of parameters.
+        """
+
+        profile = kwargs.pop("profile", None)
+        params = dict(self._profiles.get(profile, {})) if profile else {}
+        params.update(kwargs)
+        override = self._caller_profiles.get(caller)
+        if isinstance(override, str):
+            override = self._profiles.get(override, {})
+        params.update(override or {})
+        return params
+
+    @staticmethod
+    def _full_prompt(prompt, system=None):
+        return system + "\n" + prompt if system else prompt
+
+    @staticmethod
+    def _messages(prompt, system=None):
+        # 稳定的 system 前缀在前，便于服务端复用 prompt/KV 缓存
+        messages = [{"role": "user", "content": prompt}]
+        if system:
+            messages.insert(0, {"role": "system", "content": system})
+        return messages
+
+    @staticmethod
+    def _sampling_params(max_tokens=None, stop=None, top_p=None):
+        params = {"max_tokens": max_tokens, "stop": stop, "top_p": top_p}
+        return {k: v for k, v in params.items() if v is not None}
+
+    def _route(self):
+        self._endpoint = self._balancer.pick(self._endpoint)
+        return self._endpoint
+
+    def _fill_usage(self, usage, prompt, meta_response):
+        # backends fill usage when the server reports it, otherwise estimate
+        usage.setdefault("prompt_tokens", estimate_tokens(prompt))
+        usage.setdefault("completion_tokens", estimate_tokens(meta_response))
+
+    def _record_telemetry(self, caller, prompt, start, usages):
+        if not usages:
+            return
+        bytes_sent = len(prompt.encode("utf-8")) * len(usages)
+        self._telemetry.record(caller, time.time() - start, usages, bytes_sent)
+
+    def _response_format(self, schema):
+        """response_format for prompts declaring a JSON schema, None if disabled"""
+
+        if not schema or not self._structured:
+            return None
+        if self._structured == "json_schema":
+            return {
+                "type": "json_schema",
+                "json_schema": {"name": "response", "schema": schema},
+            }
+        return {"type": "json_object"}
+
+    @staticmethod
+    def _mentions_structured(error):
+        texts = [str(error), str(getattr(error, "body", "") or "")]
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                texts.append(response.text)
+            except Exception:
+                pass
+        text = " ".join(texts).lower()
+        return any(k in text for k in ("response_format", "json_schema", "json_object"))
+
+    def _downgrade_structured(self, error, schema):
+        # a client error about response_format means the backend does not support
+        # it: fall back json_schema -> json_object -> plain text. Other client errors
+        # (auth, context length ...) go through the normal error handling.
+        if not schema or not self._structured or utils.classify_error(error) != "client":
+            return False
+        if not self._mentions_structured(error):
+            return False
+        downgrade = "json_object" if self._structured == "json_schema" else False
+        print(
+            "LLMModel structured output {} rejected ({}), fall back to {}".format(
+                self._structured, error, downgrade or "plain text"
+            )
+        )
+        self._structured = downgrade
+        return True
+
+    def _on_request_error(self, name, error, breaker, attempt, retry):
+        """Record a transport level error, return the backoff delay or None to stop"""
+
+        kind = utils.classify_error(error)
+        if kind != "client":
+            breaker.failure()
+        print(f"LLMModel.{name}() caused a {kind} error: {error}")
+        if not self._retry_policy.allow_retry(attempt, retry):
+            return None
+        return self._retry_policy.delay(attempt, kind)
+
+    def _on_response(self, name, meta_response, meta_responses, callback, caller):
+        # parse errors are retried right away, the backend itself is healthy
+        try:
+            return self._handle_response(meta_response, meta_responses, callback, caller)
+        except Exception as e:
+            print(f"LLMModel.{name}() failed to parse response: {e}")
+            return None
+
+    def _handle_response(self, meta_response, meta_responses, callback, caller):
+        meta_responses.append(meta_response)
+        self._summary["total"][0] += 1
+        self._summary[caller][0] += 1
+        if callback:
+            return callback(meta_response)
+        return meta_response
+
+    def _cache_lookup(self, prompt, callback, caller, **kwargs):
+        if not self._cache or not self._cache.enabled(caller):
+            return None, None
+        stats = self._cache_summary.setdefault(caller, [0, 0])
+        sampling = {
+            k: kwargs.get(k) for k in ("temperature", "top_p", "max_tokens", "stop")
+        }
+        key = self._cache.make_key(self._model, prompt, sampling, caller)
+        meta_response = self._cache.get(key)
+        if meta_response is not None:
+            try:
+                response = callback(meta_response) if callback else meta_response
+            except Exception:
+                response = None
+            if response is not None:
+                stats[0] += 1
+                return key, response
+        stats[1] += 1
+        return key, None
+
+    def _cache_store(self, key, response, meta_responses, failsafe, caller):
+        # only cache responses that passed the callback, never freeze a failsafe
+        if not key or response is None or response is failsafe:
+            return
+        self._cache.put(key, caller, meta_responses[-1])
+
+    def _finish(self, response, meta_responses, failsafe, caller):
+        # set meta responses right before returning, so that the caller can read
+        # them without another task interleaving
+        self._meta_responses = meta_responses
+        self._failed = response is None
         pos = 2 if response is None else 1
         self._summary["total"][pos] += 1
         self._summary[caller][pos] += 1
@@ -59,6 +308,10 @@ class LLMModel:
             "_completion is not support for " + str(self.__class__)
         )
 
+    async def _acompletion(self, prompt, **kwargs):
+        # fallback for blocking backends: run the request in a worker thread
+        return await asyncio.to_thread(self._completion, prompt, **kwargs)
+
     def is_available(self):
         return self._enabled  # and self._summary["total"][2] <= 10
 
@@ -66,7 +319,18 @@ class LLMModel:
         des = {}
         for k, v in self._summary.items():
             des[k] = "S:{},F:{}/R:{}".format(v[1], v[2], v[0])
-        return {"model": self._model, "summary": des}
+            if k in self._cache_summary:
+                des[k] += ",Cache:{}/{}".format(*self._cache_summary[k])
+        if self._cache_summary:
+            hits = sum(v[0] for v in self._cache_summary.values())
+            misses = sum(v[1] for v in self._cache_summary.values())
+            des["total"] += ",Cache:{}/{}".format(hits, misses)
+        return {
+            "model": self._model,
+            "summary": des,
+            "telemetry": self._telemetry.abstract(),
+            "endpoints": self._balancer.abstract(),
+        }
 
     def disable(self):
         self._enabled = False
@@ -75,28 +339,114 @@ class LLMModel:
     def meta_responses(self):
         return self._meta_responses
 
+    @property
+    def failed(self):
+        """Whether the last completion fell back to its failsafe"""
+        return self._failed
+
 
 class OpenAILLMModel(LLMModel):
     def setup(self, config):
-        from openai import OpenAI
+        return None
 
-        return OpenAI(api_key=self._api_key, base_url=self._base_url)
+    def _completion(
+        self,
+        prompt,
+        endpoint,
+        system=None,
+        temperature=0.5,
+        stream=False,
+        usage=None,
+        schema=None,
+        max_tokens=None,
+        stop=None,
+        top_p=None,
+    ):
+        messages = self._messages(prompt, system)
+        params = self._create_params(
+            messages, temperature, schema, max_tokens=max_tokens, stop=stop, top_p=top_p
+        )
+        client = endpoint.transport.openai_client()
+        with endpoint.transport.slot():
+            if stream and self._stream:
+                return self._stream_completion(client, params)
+            response = client.chat.completions.create(**params)
+        self._read_usage(response, usage)
+        if len(response.choices) > 0:
+            return response.choices[0].message.content
+        return ""
 
-    def _completion(self, prompt, temperature=0.5):
-        messages = [{"role": "user", "content": prompt}]
-        response = self._handle.chat.completions.create(
-            model=self._model, messages=messages, temperature=temperature
+    async def _acompletion(
+        self,
+        prompt,
+        endpoint,
+        system=None,
+        temperature=0.5,
+        stream=False,
+        usage=None,
+        schema=None,
+        max_tokens=None,
+        stop=None,
+        top_p=None,
+    ):
+        messages = self._messages(prompt, system)
+        params = self._create_params(
+            messages, temperature, schema, max_tokens=max_tokens, stop=stop, top_p=top_p
         )
+        client = endpoint.transport.async_openai_client()
+        async with endpoint.transport.aslot():
+            if stream and self._stream:
+                return await self._astream_completion(client, params)
+            response = await client.chat.completions.create(**params)
+        self._read_usage(response, usage)
         if len(response.choices) > 0:
             return response.choices[0].message.content
         return ""
 
+    def _create_params(self, messages, temperature, schema, **sampling):
+        params = {"model": self._model, "messages": messages, "temperature": temperature}
+        params.update(self._sampling_params(**sampling))
+        response_format = self._response_format(schema)
+        if response_format:
+            params["response_format"] = response_format
+        return params
+
+    def _read_usage(self, response, usage):
+        if usage is not None and response.usage:
+            usage["prompt_tokens"] = response.usage.prompt_tokens
+            usage["completion_tokens"] = response.usage.completion_tokens
+
+    def _stream_completion(self, client, params):
+        scanner = JsonStreamScanner()
+        response = client.chat.completions.create(**params, stream=True)
+        try:
+            for chunk in response:
+                if chunk.choices and scanner.feed(chunk.choices[0].delta.content):
+                    break
+        finally:
+            # 拿到完整JSON后立即中断生成
+            response.close()
+        return scanner.text
+
+    async def _astream_completion(self, client, params):
+        scanner = JsonStreamScanner()
+        response = await client.chat.completions.create(**params, stream=True)
+        try:
+            async for chunk in response:
+                if chunk.choices and scanner.feed(chunk.choices[0].delta.content):
+                    break
+        finally:
+            await response.close()
+        return scanner.text
+
 
 class OllamaLLMModel(LLMModel):
     def setup(self, config):
         return None
 
-    def ollama_chat(self, messages, temperature):
+    def ollama_chat(
+        self, endpoint, messages, temperature, stream=False, schema=None, **sampling
+    ):
         headers = {
             "Content-Type": "application/json"
         }
@@ -104,37 +454,82 @@ class OllamaLLMModel(LLMModel):
             "model": self._model,
             "messages": messages,
             "temperature": temperature,
-            "stream": False,
+            "stream": stream,
         }
+        params.update(self._sampling_params(**sampling))
+        response_format = self._response_format(schema)
+        if response_format:
+            params["response_format"] = response_format
 
-        response = requests.post(
-            url=f"{self._base_url}/chat/completions",
-            headers=headers,
-            json=params,
-            stream=False
-        )
+        with endpoint.transport.slot():
+            response = endpoint.transport.session().post(
+                url=f"{endpoint.base_url}/chat/completions",
+                headers=headers,
+                json=params,
+                stream=stream,
+                timeout=endpoint.transport.timeout,
+            )
+            response.raise_for_status()
+            if stream:
+                return self._read_stream(response)
         return response.json()
 
-    def _completion(self, prompt, temperature=0.5):
+    def _read_stream(self, response):
+        scanner = JsonStreamScanner()
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices")
+                if choices and scanner.feed(choices[0].get("delta", {}).get("content")):
+                    break
+        finally:
+            # 关闭连接即中止服务端的生成
+            response.close()
+        return {"choices": [{"message": {"content": scanner.text}}]}
+
+    def _completion(
+        self,
+        prompt,
+        endpoint,
+        system=None,
+        temperature=0.5,
+        stream=False,
+        usage=None,
+        schema=None,
+        max_tokens=None,
+        stop=None,
+        top_p=None,
+    ):
         if "qwen3" in self._model and "\n/nothink" not in prompt:
             # 针对Qwen3模型禁用think，提高推理速度
             prompt += "\n/nothink"
-        messages = [{"role": "user", "content": prompt}]
-        try:
-            response = self.ollama_chat(messages=messages, temperature=temperature)
-            if response and "choices" in response and len(response["choices"]) > 0:
-                ret = response["choices"][0]["message"]["content"]
-                # 从输出结果中过滤掉<think>标签内的文字，以免影响后续逻辑
-                ret = re.sub(r"<think>.*</think>", "", ret, flags=re.DOTALL)
-                if not ret or len(ret.strip()) == 0:
-                    print(f"⚠️ Ollama returned empty content for model {self._model}")
-                return ret
-            else:
-                print(f"⚠️ Ollama response format error: {response}")
-                return ""
-        except Exception as e:
-            print(f"⚠️ Ollama request failed: {e}")
-            return ""
+        messages = self._messages(prompt, system)
+        response = self.ollama_chat(
+            endpoint,
+            messages=messages,
+            temperature=temperature,
+            stream=stream and self._stream,
+            schema=schema,
+            max_tokens=max_tokens,
+            stop=stop,
+            top_p=top_p,
+        )
+        if usage is not None and response and response.get("usage"):
+            usage["prompt_tokens"] = response["usage"].get("prompt_tokens", 0)
+            usage["completion_tokens"] = response["usage"].get("completion_tokens", 0)
+        if response and "choices" in response and len(response["choices"]) > 0:
+            ret = response["choices"][0]["message"]["content"]
+            # 从输出结果中过滤掉<think>标签内的文字，以免影响后续逻辑
+            ret = re.sub(r"<think>.*</think>", "", ret, flags=re.DOTALL)
+            if not ret or len(ret.strip()) == 0:
+                print(f"⚠️ Ollama returned empty content for model {self._model}")
+            return ret
+        print(f"⚠️ Ollama response format error: {response}")
+        return ""
 
 
 def create_llm_model(llm_config):
@@ -145,6 +540,10 @@ def create_llm_model(llm_config):
 
     elif llm_config["provider"] == "openai":
         return OpenAILLMModel(llm_config)
+    elif llm_config["provider"] == "mock":
+        from .mock import MockLLMModel
+
+        return MockLLMModel(llm_config)
     else:
         raise NotImplementedError(
             "llm provider {} is not supported".format(llm_config["provider"])
@@ -152,7 +551,80 @@ def create_llm_model(llm_config):
     return None
 
 
+_REGEX_META = set(".^$*+?{}[]()|\\")
+
+
+def _has_top_level_alternation(pattern):
+    depth, in_class, idx = 0, False, 0
+    while idx < len(pattern):
+        char = pattern[idx]
+        if char == "\\":
+            idx += 2
+            continue
+        if in_class:
+            in_class = char != "]"
+        elif char == "[":
+            in_class = True
+            # "[]" 和 "[^]" 开头的 "]" 是字面字符
+            if pattern[idx + 1 : idx + 2] == "^":
+                idx += 1
+            if pattern[idx + 1 : idx + 2] == "]":
+                idx += 1
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            return True
+        idx += 1
+    return False
+
+
+def _literal_prefix(pattern):
+    """Literal text every match of the pattern starts with, used as a cheap filter"""
+
+    if _has_top_level_alternation(pattern):
+        # "foo|bar" 的匹配不一定以任何一个分支的前缀开头，不做预过滤
+        return False, ""
+    anchored = pattern.startswith("^")
+    idx, prefix = (1 if anchored else 0), []
+    while idx < len(pattern):
+        char = pattern[idx]
+        if char == "\\" and idx + 1 < len(pattern) and not pattern[idx + 1].isalnum():
+            char, step = pattern[idx + 1], 2
+        elif char in _REGEX_META:
+            break
+        else:
+            step = 1
+        if idx + step < len(pattern) and pattern[idx + step] in "*?{":
+            break
+        prefix.append(char)
+        idx += step
+        if idx < len(pattern) and pattern[idx] == "+":
+            break
+    return anchored, "".join(prefix)
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_patterns(patterns):
+    """Compile a tuple of patterns once per call site
+
+    Returns [(regex, groups, anchored, prefix)], regex is None for an empty pattern.
+    """
+
+    compiled = []
+    for pattern in patterns:
+        if not pattern:
+            compiled.append((None, 0, False, ""))
+            continue
+        regex = re.compile(pattern)
+        compiled.append((regex, regex.groups) + _literal_prefix(pattern))
+    return compiled
+
+
 def parse_llm_output(response, patterns, mode="match_last", ignore_empty=False):
+    """Match every line against patterns, the first matching pattern wins"""
+
     # 检查空响应
     if not response or len(response.strip()) == 0:
         print(f"\n⚠️ LLM returned empty response!")
@@ -161,18 +633,31 @@ def parse_llm_output(response, patterns, mode="match_last", ignore_empty=False):
         return [] if mode == "match_all" else None
     
     if isinstance(patterns, str):
-        patterns = [patterns]
+        patterns = (patterns,)
+    compiled = compile_patterns(tuple(patterns))
     rets = []
     for line in response.split("\n"):
-        line = line.replace("**", "").strip()
-        for pattern in patterns:
-            if pattern:
-                matchs = re.findall(pattern, line)
+        if "**" in line:
+            line = line.replace("**", "")
+        line = line.strip()
+        for regex, groups, anchored, prefix in compiled:
+            if regex is None:
+                ret = line
             else:
-                matchs = [line]
-            if len(matchs) >= 1:
-                rets.append(matchs[0])
-                break
+                # 快速路径：先用字面前缀排除不可能匹配的行（如“评分”、“[HH:MM]”）
+                if prefix and not (line.startswith(prefix) if anchored else prefix in line):
+                    continue
+                match = regex.search(line)
+                if not match:
+                    continue
+                if groups == 0:
+                    ret = match.group()
+                elif groups == 1:
+                    ret = match.group(1) or ""
+                else:
+                    ret = match.groups("")
+            rets.append(ret)
+            break
     if not ignore_empty:
         if not rets:
             # 打印更详细的错误信息
@@ -0,0 +1,242 @@
+"""generative_agents.model.mock"""
+
+import re
+import json
+import math
+import time
+import random
+import asyncio
+import hashlib
+
+from .llm_model import LLMModel
+
+
+class LatencyModel:
+    """Simulated response latency, configurable per caller
+
+    config: {"distribution": "constant|uniform|normal|lognormal", "mean": 0.0,
+    "std": 0.0, "min": 0.0, "max": 10.0, "callers": {caller: {...}}}
+    """
+
+    def __init__(self, config=None):
+        config = dict(config or {})
+        self._callers = config.pop("callers", {})
+        self._default = config
+
+    def sample(self, caller, rng):
+        config = dict(self._default)
+        config.update(self._callers.get(caller, {}))
+        mean, std = config.get("mean", 0.0), config.get("std", 0.0)
+        distribution = config.get("distribution", "constant")
+        if distribution == "uniform":
+            value = rng.uniform(mean - std, mean + std)
+        elif distribution == "normal":
+            value = rng.gauss(mean, std)
+        elif distribution == "lognormal" and mean > 0:
+            # 由目标均值和标准差换算对数正态分布的参数
+            sigma2 = math.log(1 + (std / mean) ** 2)
+            mu = math.log(mean) - sigma2 / 2
+            value = rng.lognormvariate(mu, sigma2 ** 0.5)
+        else:
+            value = mean
+        return min(max(value, config.get("min", 0.0)), config.get("max", 10.0))
+
+
+class MockLLMModel(LLMModel):
+    """Offline stand-in model, answers every Scratch.prompt_* in its expected format
+
+    Responses are seeded by (caller, prompt), so a run is reproducible and needs no
+    network. Useful to benchmark the framework itself and to load-test concurrency.
+    """
+
+    def setup(self, config):
+        self._latency = LatencyModel(config.get("latency"))
+        return None
+
+    def completion(self, prompt, caller="llm_normal", **kwargs):
+        return super().completion(prompt, caller=caller, mock_caller=caller, **kwargs)
+
+    async def acompletion(self, prompt, caller="llm_normal", **kwargs):
+        return await super().acompletion(
+            prompt, caller=caller, mock_caller=caller, **kwargs
+        )
+
+    def _completion(
+        self, prompt, endpoint, system=None, mock_caller="", usage=None, **kwargs
+    ):
+        prompt = self._full_prompt(prompt, system)
+        rng = self._rng(mock_caller, prompt)
+        # 占用传输层的并发槽位，模拟真实服务端的排队
+        with endpoint.transport.slot():
+            time.sleep(self._latency.sample(mock_caller, rng))
+        return self._respond(mock_caller, prompt, rng)
+
+    async def _acompletion(
+        self, prompt, endpoint, system=None, mock_caller="", usage=None, **kwargs
+    ):
+        prompt = self._full_prompt(prompt, system)
+        rng = self._rng(mock_caller, prompt)
+        async with endpoint.transport.aslot():
+            await asyncio.sleep(self._latency.sample(mock_caller, rng))
+        return self._respond(mock_caller, prompt, rng)
+
+    def _rng(self, caller, prompt):
+        digest = hashlib.sha256((caller + "\n" + prompt).encode("utf-8")).hexdigest()
+        return random.Random(int(digest[:16], 16))
+
+    def _respond(self, caller, prompt, rng):
+        if caller.startswith("poignancy_") and caller != "poignancy_batch":
+            caller = "poignancy"
+        handler = getattr(self, "_mock_" + caller, None)
+        if handler:
+            return handler(prompt, rng)
+        return "这是一个模拟回复。"
+
+    @staticmethod
+    def _options(prompt):
+        lists = re.findall(r"列表：\[([^\[\]]*)\]|对象：\[([^\[\]]*)\]", prompt)
+        if not lists:
+            return []
+        return [o.strip() for o in "".join(lists[-1]).split(",") if o.strip()]
+
+    def _mock_poignancy(self, prompt, rng):
+        return "评分：{}".format(rng.randint(1, 10))
+
+    def _mock_poignancy_batch(self, prompt, rng):
+        events = prompt.rsplit('"""', 2)[-2] if prompt.count('"""') >= 2 else prompt
+        count = len(re.findall(r"^\[\d+\] (?:事件|对话)：", events, flags=re.M))
+        return "\n".join(
+            "[{}] 评分：{}".format(i + 1, rng.randint(1, 10)) for i in range(max(count, 1))
+        )
+
+    def _mock_wake_up(self, prompt, rng):
+        return "{}:00".format(rng.randint(5, 8))
+
+    def _mock_schedule_init(self, prompt, rng):
+        plans = ["早上7点吃早餐", "上午8点开始工作", "中午12点吃午饭", "下午2点继续工作", "晚上6点吃晚饭", "晚上10点睡觉"]
+        return "\n".join("{}. {}。".format(i + 1, p) for i, p in enumerate(plans))
+
+    def _mock_schedule_daily(self, prompt, rng):
+        hours = re.findall(r"^\[(\d{1,2}:00)\] (.*)$", prompt, flags=re.M)
+        activities = ["工作", "阅读", "散步", "和朋友聊天", "休息"]
+        lines = []
+        for hour, activity in hours:
+            if activity.strip() == "<活动>":
+                activity = rng.choice(activities)
+            lines.append("[{}] {}".format(hour, activity))
+        return "\n".join(lines)
+
+    def _mock_schedule_decompose(self, prompt, rng):
+        match = re.search(r"(\d+) 分钟为增量", prompt)
+        increment = int(match.group(1)) if match else 15
+        agent = re.search(r"^1\) (.*?) \*计划\*", prompt, flags=re.M)
+        agent = agent.group(1) if agent else "我"
+        lines, left = [], 60
+        while left > 0:
+            duration = min(increment * rng.randint(1, 2), left)
+            left -= duration
+            lines.append(
+                "{}) {} *计划* 子任务{}（耗时：{}，剩余：{}）".format(
+                    len(lines) + 1, agent, len(lines) + 1, duration, left
+                )
+            )
+        return "\n".join(lines)
+
+    def _mock_schedule_revise(self, prompt, rng):
+        blocks = prompt.split('"""')
+        plan = blocks[5] if len(blocks) > 5 else ""
+        return "\n".join(line for line in plan.strip().split("\n") if line.startswith("["))
+
+    def _mock_determine_sector(self, prompt, rng):
+        options = self._options(prompt)
+        return "应该去：" + (rng.choice(options) if options else "")
+
+    _mock_determine_arena = _mock_determine_sector
+
+    def _mock_determine_object(self, prompt, rng):
+        options = self._options(prompt)
+        return rng.choice(options) if options else ""
+
+    def _mock_describe_emoji(self, prompt, rng):
+        return rng.choice(["😊", "📖", "🍵", "💭", "🏃"])
+
+    def _mock_describe_event(self, prompt, rng):
+        action = prompt.rsplit("输入：", 1)[-1].split("\n", 1)[0].strip("。 ")
+        return "(<{}>, <{}>, <{}>)".format(action[:2] or "他", "正在", action[2:] or "休息")
+
+    def _mock_describe_object(self, prompt, rng):
+        obj = re.findall(r"描述 <(.+?)> 的状态", prompt)
+        return "<{}> 正在被使用".format(obj[-1] if obj else "物品")
+
+    def _mock_decide_chat(self, prompt, rng):
+        return "是"
+
+    def _mock_decide_chat_terminate(self, prompt, rng):
+        conversation = prompt.split("<对话记录>", 1)[-1].split("</对话记录>", 1)[0]
+        turns = len([line for line in conversation.strip().split("\n") if ": " in line])
+        return "是" if turns >= 4 else "否"
+
+    def _mock_generate_chat_check_repeat(self, prompt, rng):
+        return "否"
+
+    def _mock_decide_wait(self, prompt, rng):
+        return "答案：<选项B>"
+
+    def _mock_generate_chat(self, prompt, rng):
+        symbols = "●○◆◇▲△■□♡☆"
+        return json.dumps(
+            {
+                "scene_observation": "两人在同一个地方相遇",
+                "thinking": "我想打个招呼",
+                "chinese": "你好，今天过得怎么样",
+                "novlang": "".join(rng.choice(symbols) for _ in range(rng.randint(3, 6))),
+            },
+            ensure_ascii=False,
+        )
+
+    def _mock_understand_novlang(self, prompt, rng):
+        return json.dumps(
+            {
+                "symbol_analysis": "符号的组合像是一句问候",
+                "context_clues": "对方看着我，语气友好",
+                "my_understanding": rng.choice(["你好", "今天过得怎么样", "我们一起走吧"]),
+            },
+            ensure_ascii=False,
+        )
+
+    def _mock_verify_understanding(self, prompt, rng):
+        score = rng.randint(1, 10)
+        return json.dumps(
+            {
+                "semantic_match": "高" if score > 7 else ("中" if score > 4 else "低"),
+                "emotion_match": "一致",
+                "intent_match": "一致" if score > 4 else "不一致",
+                "overall_score": score,
+                "analysis": "模拟评估",
+                "suggestion": "",
+            },
+            ensure_ascii=False,
+        )
+
+    def _mock_summarize_history(self, prompt, rng):
+        blocks = prompt.split('"""')
+        conversation = blocks[3].strip() if len(blocks) > 3 else ""
+        return "；".join(conversation.split("\n"))[-150:]
+
+    def _mock_reflect_focus(self, prompt, rng):
+        match = re.search(r"提出 (\d+) 个", prompt)
+        number = int(match.group(1)) if match else 3
+        return "\n".join("{}. 问题{}是什么？".format(i + 1, i + 1) for i in range(number))
+
+    def _mock_reflect_insights(self, prompt, rng):
+        match = re.search(r"汇总出 (\d+) 条", prompt)
+        number = int(match.group(1)) if match else 5
+        return "\n".join(
+            "{}. 见解{} (参考信息序号 0,{})".format(i + 1, i + 1, i) for i in range(number)
+        )
+
+    def _mock_retrieve_plan(self, prompt, rng):
+        return "1. 按照昨天的日程继续工作。\n2. 记得和朋友打招呼。"
+
+    def _mock_retrieve_currently(self, prompt, rng):
+        return "状态: 正在按照计划度过新的一天。"
@@ -0,0 +1,103 @@
+"""generative_agents.model.router"""
+
+from modules import utils
+from .llm_model import create_llm_model
+
+
+class LLMRouter:
+    """Send every caller to a named model profile, fall back along a chain
+
+    think config: "llm" is the default profile, "models" holds the other profiles
+    (missing keys are inherited from "llm"), "routing" maps callers to profiles:
+    {"default": "default", "fallback": ["default"], "callers": {"poignancy_event": "small"}}.
+    Models are created on first use, so an unused profile costs nothing.
+    """
+
+    def __init__(self, think_config):
+        self._configs = {"default": think_config["llm"]}
+        for name, config in think_config.get("models", {}).items():
+            self._configs[name] = utils.update_dict(
+                utils.copy_dict(think_config["llm"]), config
+            )
+        routing = think_config.get("routing", {})
+        self._default = routing.get("default", "default")
+        self._fallback = routing.get("fallback", ["default"])
+        self._routes = routing.get("callers", {})
+        for name in [self._default] + self._fallback + list(self._routes.values()):
+            if isinstance(name, list):
+                unknown = [n for n in name if n not in self._configs]
+            else:
+                unknown = [name] if name not in self._configs else []
+            if unknown:
+                raise KeyError("llm routing refers to unknown models: " + ", ".join(unknown))
+        self._models = {}
+        self._meta_responses = []
+        self._route_summary = {}
+
+    def _model(self, name):
+        if name not in self._models:
+            self._models[name] = create_llm_model(self._configs[name])
+        return self._models[name]
+
+    def chain(self, caller):
+        """Model names to try for the caller, in order"""
+
+        route = self._routes.get(caller, self._default)
+        names = route if isinstance(route, list) else [route]
+        return list(dict.fromkeys(names + self._fallback))
+
+    def _candidates(self, caller):
+        for name in self.chain(caller):
+            model = self._model(name)
+            if model.is_available():
+                yield name, model
+
+    def _record(self, caller, name, model):
+        self._meta_responses = model.meta_responses
+        self._route_summary.setdefault(caller, {}).setdefault(name, 0)
+        self._route_summary[caller][name] += 1
+
+    def completion(self, caller="llm_normal", failsafe=None, **kwargs):
+        output = failsafe
+        for name, model in self._candidates(caller):
+            output = model.completion(caller=caller, failsafe=failsafe, **kwargs)
+            self._record(caller, name, model)
+            if not model.failed:
+                break
+            print(f"LLMRouter: {caller} failed on {name}, try next model")
+        return output
+
+    async def acompletion(self, caller="llm_normal", failsafe=None, **kwargs):
+        output = failsafe
+        for name, model in self._candidates(caller):
+            output = await model.acompletion(caller=caller, failsafe=failsafe, **kwargs)
+            self._record(caller, name, model)
+            if not model.failed:
+                break
+            print(f"LLMRouter: {caller} failed on {name}, try next model")
+        return output
+
+    def is_available(self):
+        return any(self._model(n).is_available() for n in self.chain(None))
+
+    def disable(self):
+        for model in self._models.values():
+            model.disable()
+
+    def get_summary(self):
+        if list(self._models.keys()) == ["default"] and not self._routes:
+            return self._models["default"].get_summary()
+        return {
+            "models": {n: m.get_summary() for n, m in self._models.items()},
+            "routes": self._route_summary,
+        }
+
+    @property
+    def meta_responses(self):
+        return self._meta_responses
+
+
+def create_llm_router(think_config):
+    """Create the llm router of an agent from its think config"""
+
+    return LLMRouter(think_config)
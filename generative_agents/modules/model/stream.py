@@ -0,0 +1,77 @@
+"""generative_agents.model.stream"""
+
+
+class JsonStreamScanner:
+    """Incremental scanner for streamed completions
+
+    Drops <think>...</think> blocks on the fly and reports completion as soon as
+    the first balanced {...} object has been received, so that the request can
+    be aborted without waiting for trailing output.
+    """
+
+    open_tag, close_tag = "<think>", "</think>"
+
+    def __init__(self):
+        self._chunks = []
+        self._pending = ""
+        self._in_think = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self.complete = False
+
+    def feed(self, chunk):
+        if self.complete or not chunk:
+            return self.complete
+        data, self._pending = self._pending + chunk, ""
+        while data and not self.complete:
+            tag = self.close_tag if self._in_think else self.open_tag
+            idx = data.find(tag)
+            if idx >= 0:
+                if not self._in_think:
+                    self._scan(data[:idx])
+                data = data[idx + len(tag):]
+                self._in_think = not self._in_think
+                continue
+            # 保留可能被切断的标签前缀，等待下一个分片
+            keep = self._partial_tag(data, tag)
+            if not self._in_think:
+                self._scan(data[: len(data) - keep])
+            self._pending = data[len(data) - keep:]
+            break
+        return self.complete
+
+    def _scan(self, text):
+        for idx, char in enumerate(text):
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"' and self._depth > 0:
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            elif char == "}" and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._chunks.append(text[: idx + 1])
+                    self.complete = True
+                    return
+        self._chunks.append(text)
+
+    @staticmethod
+    def _partial_tag(data, tag):
+        for size in range(min(len(tag) - 1, len(data)), 0, -1):
+            if tag.startswith(data[-size:]):
+                return size
+        return 0
+
+    @property
+    def text(self):
+        text = "".join(self._chunks)
+        if not self.complete and not self._in_think:
+            text += self._pending
+        return text
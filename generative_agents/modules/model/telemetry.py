@@ -0,0 +1,83 @@
+"""generative_agents.model.telemetry"""
+
+import collections
+
+
+def estimate_tokens(text):
+    """Rough token count: one per CJK character, one per 4 other characters"""
+
+    if not text:
+        return 0
+    cjk = sum(1 for c in text if "一" <= c <= "鿿" or "　" <= c <= "〿")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def percentile(values, q):
+    if not values:
+        return 0
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))
+    return values[idx]
+
+
+class CallerTelemetry:
+    """Latency and token statistics of one caller"""
+
+    def __init__(self, window=2000):
+        self.latencies = collections.deque(maxlen=window)
+        self.calls = 0
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.bytes_sent = 0
+
+    def record(self, latency, usages, bytes_sent):
+        self.latencies.append(latency)
+        self.calls += 1
+        self.retries += max(len(usages) - 1, 0)
+        self.prompt_tokens += sum(u.get("prompt_tokens", 0) for u in usages)
+        self.completion_tokens += sum(u.get("completion_tokens", 0) for u in usages)
+        self.bytes_sent += bytes_sent
+
+    def merge(self, other):
+        self.latencies.extend(other.latencies)
+        self.calls += other.calls
+        self.retries += other.retries
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.bytes_sent += other.bytes_sent
+
+    def abstract(self):
+        latencies = list(self.latencies)
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "latency": {
+                "p50": round(percentile(latencies, 50), 3),
+                "p95": round(percentile(latencies, 95), 3),
+                "p99": round(percentile(latencies, 99), 3),
+                "total": round(sum(latencies), 3),
+            },
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "bytes_sent": self.bytes_sent,
+        }
+
+
+class Telemetry:
+    """Per-caller telemetry of one llm model"""
+
+    def __init__(self):
+        self._callers = {}
+
+    def record(self, caller, latency, usages, bytes_sent):
+        stats = self._callers.setdefault(caller, CallerTelemetry())
+        stats.record(latency, usages, bytes_sent)
+
+    def abstract(self):
+        total = CallerTelemetry()
+        for stats in self._callers.values():
+            total.merge(stats)
+        des = {"total": total.abstract()}
+        des.update({k: v.abstract() for k, v in self._callers.items()})
+        return des
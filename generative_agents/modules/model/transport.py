@@ -0,0 +1,131 @@
+"""generative_agents.model.transport"""
+
+import asyncio
+import threading
+import contextlib
+import requests
+from requests.adapters import HTTPAdapter
+
+# 进程级传输注册表：所有 Agent 的 LLM 客户端共享连接池
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+class Transport:
+    """Pooled, keep-alive HTTP transport for one (provider, base_url, api_key)"""
+
+    def __init__(
+        self,
+        provider,
+        base_url,
+        api_key,
+        pool_size=16,
+        connect_timeout=10,
+        read_timeout=300,
+        max_inflight=8,
+    ):
+        self.provider = provider
+        self.base_url = base_url
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_inflight = max_inflight
+
+        self._lock = threading.Lock()
+        self._session = None
+        self._client = None
+        self._async_clients = {}
+        self._inflight = threading.BoundedSemaphore(max_inflight)
+        self._async_inflight = {}
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    def session(self):
+        """Shared requests session, sockets are reused across calls"""
+
+        with self._lock:
+            if not self._session:
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_size, max_retries=0
+                )
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._session = session
+        return self._session
+
+    def openai_client(self):
+        with self._lock:
+            if not self._client:
+                import httpx
+                from openai import OpenAI
+
+                self._client = OpenAI(
+                    api_key=self.api_key,
+                    base_url=self.base_url,
+                    max_retries=0,
+                    http_client=httpx.Client(
+                        limits=self._httpx_limits(), timeout=self._httpx_timeout()
+                    ),
+                )
+        return self._client
+
+    def async_openai_client(self):
+        # httpx.AsyncClient is bound to the loop it runs on, keep one per loop
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if loop not in self._async_clients:
+                import httpx
+                from openai import AsyncOpenAI
+
+                self._async_clients[loop] = AsyncOpenAI(
+                    api_key=self.api_key,
+                    base_url=self.base_url,
+                    max_retries=0,
+                    http_client=httpx.AsyncClient(
+                        limits=self._httpx_limits(), timeout=self._httpx_timeout()
+                    ),
+                )
+        return self._async_clients[loop]
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Bound the number of in-flight requests on this transport"""
+
+        with self._inflight:
+            yield
+
+    @contextlib.asynccontextmanager
+    async def aslot(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if loop not in self._async_inflight:
+                self._async_inflight[loop] = asyncio.Semaphore(self.max_inflight)
+        async with self._async_inflight[loop]:
+            yield
+
+    def _httpx_limits(self):
+        import httpx
+
+        return httpx.Limits(
+            max_connections=self.pool_size,
+            max_keepalive_connections=self.pool_size,
+        )
+
+    def _httpx_timeout(self):
+        import httpx
+
+        return httpx.Timeout(self.read_timeout, connect=self.connect_timeout)
+
+
+def get_transport(llm_config):
+    """Get the shared transport for the llm config, create it if needed"""
+
+    key = (llm_config["provider"], llm_config.get("base_url"), llm_config.get("api_key"))
+    with _transports_lock:
+        if key not in _transports:
+            _transports[key] = Transport(*key, **llm_config.get("transport", {}))
+        return _transports[key]
@@ -1,49 +1,213 @@
 """generative_agents.prompt.scratch"""
 
 import random
-import json
 import datetime
 import re
-from string import Template
 
 from modules import utils
 from modules.memory import Event
 from modules.model import parse_llm_output
+from .template import get_template_registry
+
+
+# 每个提示词模板的构造函数提供的键，Scratch 创建时用它校验模板的占位符
+PROMPT_KEYS = {
+    "poignancy_event": ("agent", "base_desc", "event"),
+    "poignancy_chat": ("agent", "base_desc", "event"),
+    "poignancy_batch": ("agent", "base_desc", "count", "events"),
+    "wake_up": ("agent", "base_desc", "lifestyle"),
+    "schedule_init": ("agent", "base_desc", "lifestyle", "wake_up"),
+    "schedule_daily": ("agent", "base_desc", "daily_schedule", "hourly_schedule"),
+    "schedule_decompose": ("agent", "base_desc", "end", "increment", "plan", "start"),
+    "schedule_revise": (
+        "agent",
+        "duration",
+        "end",
+        "event",
+        "new_plan",
+        "original_plan",
+        "start",
+    ),
+    "determine_sector": (
+        "agent",
+        "areas",
+        "complete_plan",
+        "current_arenas",
+        "current_sector",
+        "daily_plan",
+        "decomposed_plan",
+        "live_arenas",
+        "live_sector",
+    ),
+    "determine_arena": (
+        "agent",
+        "complete_plan",
+        "daily_plan",
+        "decomposed_plan",
+        "target_arenas",
+        "target_sector",
+    ),
+    "determine_object": ("activity", "objects"),
+    "describe_emoji": ("action",),
+    "describe_event": ("action",),
+    "describe_object": ("action", "agent", "object"),
+    "decide_chat": (
+        "agent",
+        "agent_status",
+        "another",
+        "another_status",
+        "chat_history",
+        "context",
+        "date",
+    ),
+    "decide_chat_terminate": ("agent", "another", "conversation"),
+    "decide_wait_example": (
+        "action",
+        "agent",
+        "another",
+        "another_action",
+        "another_status",
+        "answer",
+        "context",
+        "date",
+        "reason",
+        "status",
+    ),
+    "decide_wait": ("examples_1", "examples_2", "task"),
+    "summarize_relation": ("agent", "another", "context"),
+    "generate_chat": (
+        "address",
+        "agent",
+        "another",
+        "base_desc",
+        "conversation",
+        "current_context",
+        "current_time",
+        "previous_context",
+    ),
+    "generate_chat_check_repeat": ("agent", "content", "conversation"),
+    "understand_novlang": (
+        "conversation_history",
+        "listener",
+        "novlang_text",
+        "scene_context",
+        "speaker",
+    ),
+    "verify_understanding": (
+        "listener",
+        "listener_understanding",
+        "novlang_text",
+        "original_meaning",
+        "speaker",
+    ),
+    "summarize_chats": ("conversation",),
+    "summarize_history": ("conversation", "summary"),
+    "reflect_focus": ("number", "reference"),
+    "reflect_insights": ("number", "reference"),
+    "reflect_chat_planing": ("agent", "conversation"),
+    "reflect_chat_memory": ("agent", "conversation"),
+    "retrieve_plan": ("agent", "date", "description"),
+    "retrieve_thought": ("agent", "description"),
+    "retrieve_currently": (
+        "agent",
+        "current_time",
+        "currently",
+        "plan",
+        "thought",
+        "time",
+    ),
+    "base_desc": (
+        "age",
+        "currently",
+        "daily_plan",
+        "date",
+        "innate",
+        "learned",
+        "lifestyle",
+        "name",
+    ),
+}
 
 
 class Scratch:
     def __init__(self, name, currently, config):
         self.name = name
-        self.currently = currently
         self.config = config
         self.template_path = "data/prompts"
+        self.templates = get_template_registry(self.template_path)
+        self.templates.validate(PROMPT_KEYS)
+        self._base_desc_cache = None
+        self._focus_cache = {}
+        self.currently = currently
+
+    @property
+    def currently(self):
+        return self._currently
+
+    @currently.setter
+    def currently(self, currently):
+        self._currently = currently
+        self._base_desc_cache = None
+
+    @staticmethod
+    def _check_keys(template, data):
+        # 声明与实际传入的键不一致时尽早报错，保证启动时的校验可信
+        missing = set(PROMPT_KEYS.get(template, ())) - set(data.keys())
+        if missing:
+            raise KeyError(
+                "prompt {} declares keys it does not pass: {}".format(
+                    template, ", ".join(sorted(missing))
+                )
+            )
 
     def build_prompt(self, template, data):
-        with open(f"{self.template_path}/{template}.txt", "r", encoding="utf-8") as file:
-            file_content = file.read()
+        self._check_keys(template, data)
+        return self.templates.render(template, data)
 
-        template = Template(file_content)
-        filled_content = template.substitute(data)
+    def build_messages(self, template, data):
+        """Render the template as {"system", "prompt"}, system is the stable prefix"""
 
-        return filled_content
+        self._check_keys(template, data)
+        system, prompt = self.templates.render_parts(template, data)
+        return {"system": system, "prompt": prompt}
 
     def _base_desc(self):
-        return self.build_prompt(
-            "base_desc",
-            {
-                "name": self.name,
-                "age": self.config["age"],
-                "innate": self.config["innate"],
-                "learned": self.config["learned"],
-                "lifestyle": self.config["lifestyle"],
-                "daily_plan": self.config["daily_plan"],
-                "date": utils.get_timer().daily_format_cn(),
-                "currently": self.currently,
-            }
-        )
+        # 人物描述只随日期和 currently 变化，按天缓存
+        day = utils.get_timer().get_date("%Y%m%d")
+        if not self._base_desc_cache or self._base_desc_cache[0] != day:
+            base_desc = self.build_prompt(
+                "base_desc",
+                {
+                    "name": self.name,
+                    "age": self.config["age"],
+                    "innate": self.config["innate"],
+                    "learned": self.config["learned"],
+                    "lifestyle": self.config["lifestyle"],
+                    "daily_plan": self.config["daily_plan"],
+                    "date": utils.get_timer().daily_format_cn(),
+                    "currently": self.currently,
+                }
+            )
+            self._base_desc_cache = (day, base_desc)
+        return self._base_desc_cache[1]
+
+    def _retrieve_focus(self, agent, focus, retrieve_max):
+        """Retrieve focus nodes, reuse the result while the memory is unchanged"""
+
+        generation = agent.associate.generation
+        key = (agent.name, tuple(focus), retrieve_max)
+        cached = self._focus_cache.get(key)
+        if cached and cached[0] == generation:
+            return cached[1]
+        if any(g != generation for g, _ in self._focus_cache.values()):
+            # 记忆已变化，旧的检索结果全部作废
+            self._focus_cache = {}
+        nodes = agent.associate.retrieve_focus(focus, retrieve_max)
+        self._focus_cache[key] = (generation, nodes)
+        return nodes
 
     def prompt_poignancy_event(self, event):
-        prompt = self.build_prompt(
+        messages = self.build_messages(
             "poignancy_event",
             {
                 "base_desc": self._base_desc(),
@@ -60,13 +224,14 @@ class Scratch:
             return int(parse_llm_output(response, pattern, "match_last"))
 
         return {
-            "prompt": prompt,
+            **messages,
             "callback": _callback,
             "failsafe": random.choice(list(range(10))) + 1,
+            "profile": "short",
         }
 
     def prompt_poignancy_chat(self, event):
-        prompt = self.build_prompt(
+        messages = self.build_messages(
             "poignancy_chat",
             {
                 "base_desc": self._base_desc(),
@@ -83,13 +248,56 @@ class Scratch:
             return int(parse_llm_output(response, pattern, "match_last"))
 
         return {
-            "prompt": prompt,
+            **messages,
             "callback": _callback,
             "failsafe": random.choice(list(range(10))) + 1,
+            "profile": "short",
+        }
+
+    def prompt_poignancy_batch(self, items):
+        """Score several (node_type, event) items with one prompt"""
+
+        lines = []
+        for idx, (e_type, event) in enumerate(items):
+            label = "对话" if e_type == "chat" else "事件"
+            lines.append("[{}] {}：{}".format(idx + 1, label, event.get_describe()))
+
+        messages = self.build_messages(
+            "poignancy_batch",
+            {
+                "base_desc": self._base_desc(),
+                "agent": self.name,
+                "count": len(items),
+                "events": "\n".join(lines),
+            }
+        )
+
+        failsafe = [random.choice(list(range(10))) + 1 for _ in items]
+
+        def _callback(response):
+            pattern = [
+                r"\[(\d{1,2})\][^\d]*?(\d{1,2})",
+                r"^(\d{1,2})[\.、:：)）][^\d]*?(\d{1,2})",
+            ]
+            outputs = parse_llm_output(response, pattern, "match_all")
+            scores = {}
+            for idx, score in outputs:
+                idx, score = int(idx) - 1, int(score)
+                if 0 <= idx < len(items) and 1 <= score <= 10:
+                    scores.setdefault(idx, score)
+            if not scores:
+                raise ValueError("Can not find poignancy scores")
+            # 解析失败的条目单独回退到failsafe
+            return [scores.get(i, failsafe[i]) for i in range(len(items))]
+
+        return {
+            **messages,
+            "callback": _callback,
+            "failsafe": failsafe,
         }
 
     def prompt_wake_up(self):
-        prompt = self.build_prompt(
+        messages = self.build_messages(
             "wake_up",
             {
                 "base_desc": self._base_desc(),
@@ -114,10 +322,10 @@ class Scratch:
                 # 默认返回6点起床
                 return 6
 
-        return {"prompt": prompt, "callback": _callback, "failsafe": 6}
+        return {**messages, "callback": _callback, "failsafe": 6, "profile": "short"}
 
     def prompt_schedule_init(self, wake_up):
-        prompt = self.build_prompt(
+        messages = self.build_messages(
             "schedule_init",
             {
                 "base_desc": self._base_desc(),
@@ -160,7 +368,7 @@ class Scratch:
             "晚上7点放松一下，看电视",
             "晚上11点睡觉",
         ]
-        return {"prompt": prompt, "callback": _callback, "failsafe": failsafe}
+        return {**messages, "callback": _callback, "failsafe": failsafe}
 
     def prompt_schedule_daily(self, wake_up, daily_schedule):
         hourly_schedule = ""
@@ -169,7 +377,7 @@ class Scratch:
         for i in range(wake_up, 24):
             hourly_schedule += f"[{i}:00] <活动>\n"
 
-        prompt = self.build_prompt(
+        messages = self.build_messages(
             "schedule_daily",
             {
                 "base_desc": self._base_desc(),
@@ -222,7 +430,7 @@ class Scratch:
                 print(f"⚠️ schedule_daily parsing error: {e}, using failsafe")
                 return failsafe
 
-        return {"prompt": prompt, "callback": _callback, "failsafe": failsafe}
+        return {**messages, "callback": _callback, "failsafe": failsafe}
 
     def prompt_schedule_decompose(self, plan, schedule):
         def _plan_des(plan):
@@ -236,7 +444,7 @@ class Scratch:
         start, end = schedule.plan_stamps(plan, time_format="%H:%M")
         increment = max(int(plan["duration"] / 100) * 5, 5)
 
-        prompt = self.build_prompt(
+        messages = self.build_messages(
             "schedule_decompose",
             {
                 "base_desc": self._base_desc(),
@@ -273,7 +481,7 @@ class Scratch:
                 return [(plan["describe"], 10) for _ in range(int(plan["duration"] / 10))]
 
         failsafe = [(plan["describe"], 10) for _ in range(int(plan["duration"] / 10))]
-        return {"prompt": prompt, "callback": _callback, "failsafe": failsafe}
+        return {**messages, "callback": _callback, "failsafe": failsafe}
 
     def prompt_schedule_revise(self, action, schedule):
         plan, _ = schedule.current_plan()
@@ -483,7 +691,13 @@ class Scratch:
 
             return parse_llm_output(response, ["Emoji: (.*)"])[:3]
 
-        return {"prompt": prompt, "callback": _callback, "failsafe": "💭", "retry": 1}
+        return {
+            "prompt": prompt,
+            "callback": _callback,
+            "failsafe": "💭",
+            "retry": 1,
+            "profile": "short",
+        }
 
     def prompt_describe_event(self, subject, describe, address, emoji=None):
         prompt = self.build_prompt(
@@ -584,7 +798,12 @@ class Scratch:
             # 默认返回True（鼓励对话）
             return True
 
-        return {"prompt": prompt, "callback": _callback, "failsafe": False}
+        return {
+            "prompt": prompt,
+            "callback": _callback,
+            "failsafe": False,
+            "profile": "decision",
+        }
 
     def prompt_decide_chat_terminate(self, agent, other, chats):
         conversation = "\n".join(["{}: {}".format(n, u) for n, u in chats])
@@ -606,7 +825,12 @@ class Scratch:
                 return False
             return True
 
-        return {"prompt": prompt, "callback": _callback, "failsafe": False}
+        return {
+            "prompt": prompt,
+            "callback": _callback,
+            "failsafe": False,
+            "profile": "decision",
+        }
 
     def prompt_decide_wait(self, agent, other, focus):
         example1 = self.build_prompt(
@@ -681,10 +905,15 @@ class Scratch:
         def _callback(response):
             return "A" in response
 
-        return {"prompt": prompt, "callback": _callback, "failsafe": False}
+        return {
+            "prompt": prompt,
+            "callback": _callback,
+            "failsafe": False,
+            "profile": "decision",
+        }
 
     def prompt_summarize_relation(self, agent, other_name):
-        nodes = agent.associate.retrieve_focus([other_name], 50)
+        nodes = self._retrieve_focus(agent, [other_name], 50)
 
         prompt = self.build_prompt(
             "summarize_relation",
@@ -706,7 +935,7 @@ class Scratch:
 
     def prompt_generate_chat(self, agent, other, relation, chats):
         focus = [other.get_event().get_describe()]
-        nodes = agent.associate.retrieve_focus(focus, 5) 
+        nodes = self._retrieve_focus(agent, focus, 5)
         
         if chats:
             conversation_lines = []
@@ -729,7 +958,7 @@ class Scratch:
             f"看到 {other.name} 正在 {other.get_event().get_describe(False)}。"
         )
 
-        prompt = self.build_prompt(
+        messages = self.build_messages(
             "generate_chat",
             {
                 "agent": agent.name,
@@ -744,20 +973,8 @@ class Scratch:
         )
 
         def _callback(response):
-            if "{" not in response or "}" not in response:
-                raise ValueError("LLM output缺少JSON结构：" + response)
-            snippet = "{" + response.split("{", 1)[1].rsplit("}", 1)[0] + "}"
-            normalized = self._normalize_chat_json(snippet)
-            try:
-                json_content = utils.load_dict(normalized)
-            except Exception:
-                try:
-                    json_content = json.loads(normalized, strict=False)
-                except Exception as exc:
-                    raise ValueError(
-                        f"LLM output不是合法JSON：{response}\nNormalized: {normalized}"
-                    ) from exc
-            
+            json_content = self._load_json("generate_chat", response)
+
             # 新格式支持：scene_observation, thinking, chinese, novlang
             novlang = json_content.get("novlang", "") or json_content.get("text", "") or json_content.get(agent.name, "")
             novlang = novlang.replace("\n\n", "\n").strip(' \n"\'')
@@ -776,8 +993,19 @@ class Scratch:
             }
 
         return {
-            "prompt": prompt,
+            **messages,
             "callback": _callback,
+            "stream": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "scene_observation": {"type": "string"},
+                    "thinking": {"type": "string"},
+                    "chinese": {"type": "string"},
+                    "novlang": {"type": "string"},
+                },
+                "required": ["scene_observation", "thinking", "chinese", "novlang"],
+            },
             "failsafe": {
                 "scene_observation": "...",
                 "thinking": "...",
@@ -786,35 +1014,15 @@ class Scratch:
             },
         }
 
-    def _normalize_chat_json(self, text):
-        replacements = {
-            # "“": '"',  # Disable replacing double smart quotes to avoid breaking inner content if used as text
-            # "”": '"',
-            # "‘": '"',
-            # "’": '"',
-            # "＂": '"',
-            # "＇": '"',
-        }
-        for src, dst in replacements.items():
-            text = text.replace(src, dst)
-        
-        # [Added] Replace newlines and tabs with spaces to handle unescaped control chars in JSON strings
-        text = text.replace("\n", " ").replace("\r", "").replace("\t", " ")
-        
-            # [Added] Escape characters that are invalid in JSON strings but not yet escaped
-            # This is a basic attempt to fix common issues like unescaped quotes inside strings
-            # Note: This is risky if patterns are complex, but helps with simple nested quotes
-            # A better approach relies on the LLM generating valid JSON, this is a last resort.
-            
-            # 去掉 JSON 对象或数组结尾处多余的逗号
-        text = re.sub(r",\s*([}\]])", r"\1", text)
-            
-            # [Added] Try to fix common "double quote inside double quote" issue
-            # e.g. "key": "say "hello" world" -> "key": "say 'hello' world"
-            # This is hard to do perfectly with regex without a full parser, 
-            # so we'll trust the previous cleanups did most of the work.
-        
-        return text
+    def _load_json(self, caller, response):
+        json_content, report = utils.load_json_lenient(response)
+        if report["salvaged"]:
+            print(
+                "{}.{} salvaged {} ({})".format(
+                    self.name, caller, ", ".join(report["salvaged"]), ", ".join(report["repairs"])
+                )
+            )
+        return json_content
 
     def prompt_generate_chat_check_repeat(self, agent, chats, content):
         conversation = "\n".join(["{}: {}".format(n, u) for n, u in chats])
@@ -836,11 +1044,16 @@ class Scratch:
                 return False
             return True
 
-        return {"prompt": prompt, "callback": _callback, "failsafe": False}
+        return {
+            "prompt": prompt,
+            "callback": _callback,
+            "failsafe": False,
+            "profile": "decision",
+        }
 
     def prompt_understand_novlang(self, listener, speaker, novlang_text, scene_context, conversation_history):
         """让listener尝试理解speaker说的Novlang"""
-        prompt = self.build_prompt(
+        messages = self.build_messages(
             "understand_novlang",
             {
                 "listener": listener,
@@ -852,27 +1065,8 @@ class Scratch:
         )
 
         def _callback(response):
-            # [Added] Strip markdown code blocks ```json ... ```
-            response = response.strip()
-            if response.startswith("```"):
-                # Remove first line (```json or ```)
-                response = response.split("\n", 1)[1] if "\n" in response else ""
-                # Remove last line (```)
-                if response.strip().endswith("```"):
-                     response = response.rsplit("```", 1)[0]
-
-            if "{" not in response or "}" not in response:
-                raise ValueError("LLM output缺少JSON结构：" + response)
-            snippet = "{" + response.split("{", 1)[1].rsplit("}", 1)[0] + "}"
-            normalized = self._normalize_chat_json(snippet)
-            try:
-                json_content = utils.load_dict(normalized)
-            except Exception:
-                try:
-                    json_content = json.loads(normalized, strict=False)
-                except Exception as exc:
-                    raise ValueError(f"LLM output不是合法JSON：{response}\nNormalized: {normalized}") from exc
-            
+            json_content = self._load_json("understand_novlang", response)
+
             return {
                 "symbol_analysis": json_content.get("symbol_analysis", ""),
                 "context_clues": json_content.get("context_clues", ""),
@@ -880,14 +1074,24 @@ class Scratch:
             }
 
         return {
-            "prompt": prompt,
+            **messages,
             "callback": _callback,
+            "stream": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "symbol_analysis": {"type": "string"},
+                    "context_clues": {"type": "string"},
+                    "my_understanding": {"type": "string"},
+                },
+                "required": ["symbol_analysis", "context_clues", "my_understanding"],
+            },
             "failsafe": {"symbol_analysis": "", "context_clues": "", "my_understanding": "我不太理解"},
         }
 
     def prompt_verify_understanding(self, speaker, listener, original_meaning, novlang_text, listener_understanding):
         """验证listener是否正确理解了speaker的意思"""
-        prompt = self.build_prompt(
+        messages = self.build_messages(
             "verify_understanding",
             {
                 "speaker": speaker,
@@ -899,35 +1103,12 @@ class Scratch:
         )
 
         def _callback(response):
-            # [Added] Strip markdown code blocks ```json ... ```
-            response = response.strip()
-            if response.startswith("```"):
-                # Remove first line (```json or ```)
-                response = response.split("\n", 1)[1] if "\n" in response else ""
-                # Remove last line (```)
-                if response.strip().endswith("```"):
-                     response = response.rsplit("```", 1)[0]
-            
             # [Added] Truncate very long responses (likely hallucination loops)
             if len(response) > 5000:
                 print(f"⚠️ Response truncated from {len(response)} chars to 5000 chars (Loop detection)")
-                # Try to find the last complete JSON object closing brace before the cut
-                cutoff = response[:5000].rfind("}")
-                if cutoff != -1:
-                    response = response[:cutoff+1] + "}"
-            
-            if "{" not in response or "}" not in response:
-                raise ValueError("LLM output缺少JSON结构：" + response[:200] + "...")
-            snippet = "{" + response.split("{", 1)[1].rsplit("}", 1)[0] + "}"
-            normalized = self._normalize_chat_json(snippet)
-            try:
-                json_content = utils.load_dict(normalized)
-            except Exception:
-                try:
-                    json_content = json.loads(normalized, strict=False)
-                except Exception as exc:
-                    raise ValueError(f"LLM output不是合法JSON：{response}\nNormalized: {normalized}") from exc
-            
+                response = response[:5000]
+            json_content = self._load_json("verify_understanding", response)
+
             return {
                 "semantic_match": json_content.get("semantic_match", "低"),
                 "emotion_match": json_content.get("emotion_match", "不一致"),
@@ -938,8 +1119,28 @@ class Scratch:
             }
 
         return {
-            "prompt": prompt,
+            **messages,
             "callback": _callback,
+            "stream": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "semantic_match": {"type": "string", "enum": ["高", "中", "低"]},
+                    "emotion_match": {"type": "string", "enum": ["一致", "不一致"]},
+                    "intent_match": {"type": "string", "enum": ["一致", "不一致"]},
+                    "overall_score": {"type": "integer", "minimum": 1, "maximum": 10},
+                    "analysis": {"type": "string"},
+                    "suggestion": {"type": "string"},
+                },
+                "required": [
+                    "semantic_match",
+                    "emotion_match",
+                    "intent_match",
+                    "overall_score",
+                    "analysis",
+                    "suggestion",
+                ],
+            },
             "failsafe": {
                 "semantic_match": "中",
                 "emotion_match": "一致",
@@ -974,6 +1175,30 @@ class Scratch:
             "failsafe": failsafe,
         }
 
+    def prompt_summarize_history(self, summary, chats):
+        """Fold older turns of a conversation into the rolling summary"""
+
+        conversation = "\n".join(["{}: {}".format(n, c) for n, c in chats])
+
+        prompt = self.build_prompt(
+            "summarize_history",
+            {
+                "summary": summary or "[暂无]",
+                "conversation": conversation,
+            }
+        )
+
+        def _callback(response):
+            return response.strip()
+
+        failsafe = "；".join(filter(None, [summary, conversation.replace("\n", "；")]))
+
+        return {
+            "prompt": prompt,
+            "callback": _callback,
+            "failsafe": failsafe[-300:],
+        }
+
     def prompt_reflect_focus(self, nodes, topk):
         prompt = self.build_prompt(
             "reflect_focus",
@@ -0,0 +1,123 @@
+"""generative_agents.prompt.template"""
+
+import os
+import time
+import threading
+from string import Template
+
+# 进程级模板注册表，所有 Agent 共享已编译的模板
+_registries = {}
+_registries_lock = threading.Lock()
+
+# 模板中这一行之前是稳定的 system 部分，之后是每次变化的 user 部分
+USER_MARKER = "---user---"
+
+
+class TemplateRegistry:
+    """Load every prompt template of a folder once and keep them compiled
+
+    Templates are checked for invalid placeholders on load, and validate() checks
+    them against the keys their builders supply, so both fail at startup.
+    Files are re-checked at most every reload_interval seconds and reloaded when
+    their mtime changes, which keeps prompt editing during development working.
+    A template may split its stable system part from the per-call user part with
+    a USER_MARKER line.
+    """
+
+    def __init__(self, path="data/prompts", reload_interval=2):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._templates = {}
+        self._checked = {}
+        self._lock = threading.Lock()
+        for file in sorted(os.listdir(path)):
+            if file.endswith(".txt"):
+                self._load(file[: -len(".txt")])
+
+    def _file(self, name):
+        return os.path.join(self.path, name + ".txt")
+
+    def _load(self, name):
+        file = self._file(name)
+        mtime = os.path.getmtime(file)
+        with open(file, "r", encoding="utf-8") as f:
+            content = f.read()
+        parts = content.split("\n" + USER_MARKER + "\n", 1)
+        if len(parts) == 1:
+            parts = [None, content]
+        parts = [Template(p) if p is not None else None for p in parts]
+        identifiers = set()
+        for template in parts:
+            if not template:
+                continue
+            if not template.is_valid():
+                raise ValueError("prompt template {} has invalid placeholders".format(file))
+            identifiers.update(template.get_identifiers())
+        self._templates[name] = (mtime, parts, identifiers)
+        self._checked[name] = time.time()
+        return self._templates[name]
+
+    def _get(self, name):
+        with self._lock:
+            if name not in self._templates:
+                if not os.path.exists(self._file(name)):
+                    raise FileNotFoundError("prompt template {} not found".format(self._file(name)))
+                return self._load(name)
+            entry = self._templates[name]
+            if time.time() - self._checked[name] < self.reload_interval:
+                return entry
+            self._checked[name] = time.time()
+            if os.path.getmtime(self._file(name)) != entry[0]:
+                return self._load(name)
+            return entry
+
+    def identifiers(self, name):
+        return self._get(name)[2]
+
+    def validate(self, supplied):
+        """Check that the keys supplied for every template cover its placeholders
+
+        supplied maps template name -> keys its builder passes, raises ValueError
+        listing every template with unknown name or missing keys.
+        """
+
+        errors = []
+        for name, keys in sorted(supplied.items()):
+            if not os.path.exists(self._file(name)):
+                errors.append("{} not found".format(self._file(name)))
+                continue
+            missing = self.identifiers(name) - set(keys)
+            if missing:
+                errors.append("{} misses {}".format(name, ", ".join(sorted(missing))))
+        if errors:
+            raise ValueError("prompt templates do not match their builders: " + "; ".join(errors))
+
+    def render_parts(self, name, data):
+        """Render the template as (system, user), system is None if not split"""
+
+        _, (system, user), identifiers = self._get(name)
+        missing = identifiers - set(data.keys())
+        if missing:
+            raise KeyError(
+                "prompt {} misses placeholders: {}".format(name, ", ".join(sorted(missing)))
+            )
+        return system.substitute(data) if system else None, user.substitute(data)
+
+    def render(self, name, data):
+        system, user = self.render_parts(name, data)
+        if system is None:
+            return user
+        return system + "\n" + user
+
+    @property
+    def names(self):
+        return list(self._templates.keys())
+
+
+def get_template_registry(path="data/prompts"):
+    """Get the shared template registry of the folder, load it if needed"""
+
+    with _registries_lock:
+        if path not in _registries:
+            _registries[path] = TemplateRegistry(path)
+        return _registries[path]
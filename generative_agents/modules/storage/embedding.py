@@ -0,0 +1,433 @@
+"""generative_agents.storage.embedding"""
+
+import re
+import math
+import json
+import time
+import asyncio
+import hashlib
+import threading
+import contextlib
+from typing import List
+
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.core.schema import MetadataMode
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+from modules import utils
+from .embedding_cache import get_embedding_cache
+
+# 每个 embedding 服务（base_url 或 provider）一个并发槽位，代替固定的请求间隔
+_embedding_slots = {}
+_embedding_slots_lock = threading.Lock()
+
+# 按 embedding 配置共享模型和批量队列，所有 Agent 只加载一次模型
+_embeddings = {}
+_embeddings_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def embedding_slot(endpoint, max_concurrency=1):
+    """Hold one of the max_concurrency slots of the embedding endpoint"""
+
+    with _embedding_slots_lock:
+        if endpoint not in _embedding_slots:
+            _embedding_slots[endpoint] = threading.BoundedSemaphore(max(max_concurrency, 1))
+        slot = _embedding_slots[endpoint]
+    with slot:
+        yield
+
+
+class EmbeddingQueue:
+    """Collect nodes to embed and flush them in batches through get_text_embedding_batch
+
+    The queue is shared by every index of one embedding config, so nodes of all agents
+    go through the model in the same batch. A batch is flushed by a background worker
+    once it holds batch_size nodes or its oldest node waited flush_interval seconds.
+    Readers call flush(sink) first, which embeds what is left in the calling thread and
+    waits for the running batch. Every node comes with the sink(nodes, vectors) of
+    its index; sinks run outside the queue lock. A node that failed max_retries
+    batches is dropped and the error is raised by the next flush() of its sink.
+    """
+
+    def __init__(
+        self,
+        embed_model,
+        endpoint,
+        retry_policy,
+        batch_size=16,
+        flush_interval=0.5,
+        max_retries=3,
+    ):
+        self._embed_model = embed_model
+        self._endpoint = endpoint
+        self._retry_policy = retry_policy
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.max_retries = max(max_retries, 1)
+        self._pending = []
+        self._since = None
+        self._inflight = 0
+        self._errors = {}
+        self._cond = threading.Condition()
+        # 串行执行 sink，允许 sink 内部再次 put/flush
+        self._sink_lock = threading.RLock()
+        self._local = threading.local()
+        self._worker = None
+        if self.batch_size > 1:
+            self._worker = threading.Thread(target=self._work, daemon=True)
+            self._worker.start()
+
+    def _embed(self, batch):
+        texts = [n.get_content(metadata_mode=MetadataMode.EMBED) for n, _, _ in batch]
+        return self._retry_policy.call(
+            self._embed_model.get_text_embedding_batch,
+            texts,
+            endpoint=self._endpoint,
+            name="EmbeddingQueue.flush()",
+        )
+
+    def _take(self):
+        # caller holds self._cond
+        batch, self._pending = self._pending, []
+        self._since = None
+        self._inflight += 1
+        return batch
+
+    def _done(self, batch, vectors, error=None):
+        """Hand the vectors to the sinks, or requeue the batch if it failed"""
+
+        groups = {}
+        with self._cond:
+            if vectors is not None:
+                # 按所属索引分组写入
+                for (node, sink, _), vector in zip(batch, vectors):
+                    nodes, group_vectors = groups.setdefault(sink, ([], []))
+                    nodes.append(node)
+                    group_vectors.append(vector)
+            else:
+                # 失败的批次放回队首重试，超过次数的节点丢弃并把错误留给其 sink
+                retry, dropped = [], 0
+                for node, sink, attempts in batch:
+                    if attempts + 1 < self.max_retries:
+                        retry.append((node, sink, attempts + 1))
+                    else:
+                        self._errors[sink] = error
+                        dropped += 1
+                if dropped:
+                    print(f"EmbeddingQueue dropped {dropped} nodes after {self.max_retries} attempts: {error}")
+                self._pending = retry + self._pending
+                if self._pending:
+                    self._since = self._since or time.time()
+        try:
+            with self._sink_lock:
+                in_sink = getattr(self._local, "in_sink", False)
+                self._local.in_sink = True
+                try:
+                    for sink, (nodes, group_vectors) in groups.items():
+                        sink(nodes, group_vectors)
+                finally:
+                    self._local.in_sink = in_sink
+        finally:
+            with self._cond:
+                self._inflight -= 1
+                self._cond.notify_all()
+
+    def _run(self, batch):
+        try:
+            vectors, error = self._embed(batch), None
+        except Exception as e:
+            print(f"EmbeddingQueue failed to embed {len(batch)} nodes: {e}")
+            vectors, error = None, e
+        self._done(batch, vectors, error)
+        return error
+
+    def put(self, node, sink):
+        with self._cond:
+            self._pending.append((node, sink, 0))
+            self._since = self._since or time.time()
+            self._cond.notify_all()
+        if not self._worker:
+            self.flush(sink)
+
+    def _ready(self):
+        if not self._pending:
+            return False
+        if len(self._pending) >= self.batch_size:
+            return True
+        return time.time() - self._since >= self.flush_interval
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._ready():
+                    timeout = None
+                    if self._pending:
+                        timeout = max(self._since + self.flush_interval - time.time(), 0.01)
+                    self._cond.wait(timeout)
+                batch = self._take()
+            if self._run(batch) is not None:
+                time.sleep(self.flush_interval)
+
+    def flush(self, sink=None):
+        """Embed every queued node, raise the error of nodes of sink that were dropped"""
+
+        for _ in range(self.max_retries):
+            with self._cond:
+                batch = self._take() if self._pending else None
+            if not batch or self._run(batch) is None:
+                break
+        # 在 sink 内部调用时不等待，否则会等待自身所在的批次
+        if not getattr(self._local, "in_sink", False):
+            with self._cond:
+                while self._inflight:
+                    self._cond.wait()
+        if sink is not None:
+            with self._cond:
+                error = self._errors.pop(sink, None)
+            if error is not None:
+                raise error
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+
+class HashEmbedding(BaseEmbedding):
+    """Offline embedding by feature hashing, texts sharing words stay close
+
+    Every word (and every CJK character) is hashed into one signed dimension, so the
+    vector of a text is deterministic and needs no model or network.
+    """
+
+    dim: int = 384
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "HashEmbedding"
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.dim
+        for token in re.findall(r"[一-鿿]|[^\s一-鿿]+", text.lower()):
+            digest = hashlib.sha256(token.encode("utf-8")).digest()
+            idx = int.from_bytes(digest[:4], "little") % self.dim
+            vector[idx] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector))
+        if not norm:
+            vector[int(hashlib.sha256(text.encode("utf-8")).hexdigest(), 16) % self.dim] = 1.0
+            return vector
+        return [v / norm for v in vector]
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._embed(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._embed(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._embed(text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(t) for t in texts]
+
+
+class SharedEmbedding(BaseEmbedding):
+    """Embedding model shared by all agents, every call holds a slot of the endpoint
+
+    Local models (hugging_face) run one batch at a time, remote providers accept up
+    to max_concurrency concurrent requests.
+    """
+
+    _inner: BaseEmbedding = PrivateAttr()
+    _endpoint: str = PrivateAttr()
+    _max_concurrency: int = PrivateAttr()
+
+    def __init__(self, inner, endpoint, max_concurrency=1, **kwargs):
+        super().__init__(
+            model_name=inner.model_name, embed_batch_size=inner.embed_batch_size, **kwargs
+        )
+        self._inner = inner
+        self._endpoint = endpoint
+        self._max_concurrency = max_concurrency
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "SharedEmbedding"
+
+    @property
+    def inner(self):
+        return self._inner
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        with embedding_slot(self._endpoint, self._max_concurrency):
+            return self._inner.get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return await asyncio.to_thread(self._get_query_embedding, query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        with embedding_slot(self._endpoint, self._max_concurrency):
+            return self._inner.get_text_embedding_batch(texts)
+
+
+class CachedEmbedding(BaseEmbedding):
+    """Put the shared EmbeddingCache in front of any embedding model
+
+    Query and text embeddings are cached apart, some models embed them differently.
+    """
+
+    _inner: BaseEmbedding = PrivateAttr()
+    _cache: object = PrivateAttr()
+
+    def __init__(self, inner, cache, **kwargs):
+        super().__init__(
+            model_name=kwargs.pop("model_name", inner.model_name),
+            embed_batch_size=inner.embed_batch_size,
+            **kwargs,
+        )
+        self._inner = inner
+        self._cache = cache
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def inner(self):
+        return self._inner
+
+    def _lookup(self, kind, texts, embed):
+        vectors = self._cache.get_many(self.model_name, kind, texts)
+        misses = [i for i, v in enumerate(vectors) if v is None]
+        if misses:
+            computed = embed([texts[i] for i in misses])
+            self._cache.put_many(self.model_name, kind, [texts[i] for i in misses], computed)
+            for i, vector in zip(misses, computed):
+                vectors[i] = vector
+        return vectors
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._lookup(
+            "query", [query], lambda t: [self._inner.get_query_embedding(t[0])]
+        )[0]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        vector = self._cache.get_many(self.model_name, "query", [query])[0]
+        if vector is None:
+            vector = await self._inner.aget_query_embedding(query)
+            self._cache.put_many(self.model_name, "query", [query], [vector])
+        return vector
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._lookup("text", texts, self._inner.get_text_embedding_batch)
+
+
+def _endpoint(embedding_config):
+    return embedding_config.get("base_url") or embedding_config["provider"]
+
+
+def _embedding_key(embedding_config):
+    return json.dumps(embedding_config, sort_keys=True, ensure_ascii=False)
+
+
+def get_embedding(embedding_config):
+    """Get the embedding model shared by all indexes of the config, create it if needed"""
+
+    key = _embedding_key(embedding_config)
+    with _embeddings_lock:
+        if key not in _embeddings:
+            _embeddings[key] = {"model": create_embedding(embedding_config)}
+        return _embeddings[key]["model"]
+
+
+def get_embedding_queue(embedding_config):
+    """Get the batching queue shared by all indexes of the config
+
+    embedding config: "batch": {"size": 16, "interval": 0.5}, a size of 1 embeds
+    every node synchronously; "max_concurrency" limits the concurrent requests of
+    the endpoint over all agents.
+    """
+
+    embed_model = get_embedding(embedding_config)
+    key = _embedding_key(embedding_config)
+    with _embeddings_lock:
+        entry = _embeddings[key]
+        if "queue" not in entry:
+            batch = embedding_config.get("batch", {})
+            entry["queue"] = EmbeddingQueue(
+                embed_model,
+                _endpoint(embedding_config),
+                utils.RetryPolicy(**embedding_config.get("retry", {})),
+                batch_size=batch.get("size", 16),
+                flush_interval=batch.get("interval", 0.5),
+                max_retries=batch.get("max_retries", 3),
+            )
+        return entry["queue"]
+
+
+def create_embedding(embedding_config):
+    """Create embedding model, wrapped by the embedding cache if it is enabled
+
+    Indexes should use get_embedding instead, which shares one model per config.
+    """
+
+    embed_model = SharedEmbedding(
+        _create_embedding(embedding_config),
+        _endpoint(embedding_config),
+        embedding_config.get("max_concurrency", 1),
+    )
+    cache = get_embedding_cache(embedding_config.get("cache"))
+    if not cache:
+        return embed_model
+    # 缓存按 provider、模型和维度区分，切换模型不会读到旧向量
+    model_key = "{}:{}:{}".format(
+        embedding_config["provider"],
+        embedding_config.get("model", ""),
+        embedding_config.get("dim", ""),
+    )
+    return CachedEmbedding(embed_model, cache, model_name=model_key)
+
+
+def _create_embedding(embedding_config):
+    provider = embedding_config["provider"]
+    if provider == "hugging_face":
+        from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+
+        return HuggingFaceEmbedding(model_name=embedding_config["model"])
+    if provider == "ollama":
+        from llama_index.embeddings.ollama import OllamaEmbedding
+
+        return OllamaEmbedding(
+            model_name=embedding_config["model"],
+            base_url=embedding_config["base_url"],
+            ollama_additional_kwargs={"mirostat": 0},
+            request_timeout=120.0,  # 增加超时到120秒
+        )
+    if provider == "openai":
+        from llama_index.embeddings.openai import OpenAIEmbedding
+
+        return OpenAIEmbedding(
+            model_name=embedding_config["model"],
+            api_base=embedding_config["base_url"],
+            api_key=embedding_config["api_key"],
+        )
+    if provider == "local_service":
+        from .embedding_server import ServiceEmbedding, DEFAULT_ADDRESS
+
+        return ServiceEmbedding(
+            model_name=embedding_config["model"],
+            address=embedding_config.get("address", DEFAULT_ADDRESS),
+            timeout=embedding_config.get("timeout", 120.0),
+        )
+    if provider == "mock":
+        return HashEmbedding(
+            model_name=embedding_config.get("model", "mock"),
+            dim=embedding_config.get("dim", 384),
+        )
+    raise NotImplementedError("embedding provider {} is not supported".format(provider))
@@ -0,0 +1,215 @@
+"""generative_agents.storage.embedding_cache"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import contextlib
+
+import numpy as np
+
+# 按目录共享缓存实例，所有 Agent 共用同一份向量文件
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class EmbeddingCache:
+    """Persistent (model, text) -> vector cache, shared by agents and runs
+
+    Vectors of a model live in one float32 file mapped with np.memmap, a SQLite index
+    maps the text hash to its row. Once max_entries rows of a model are used, the
+    least recently accessed rows are evicted and their slots reused. Lookups run in
+    shared read transactions, writes in a BEGIN EXCLUSIVE one, so concurrent
+    experiments sharing the folder never hand out, overwrite or read a slot that is
+    being reused. Access times of hits are buffered and written with the next write.
+    """
+
+    def __init__(self, path="results/embedding_cache", max_entries=50000, **kwargs):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._vectors = {}
+        self._touched = {}
+        os.makedirs(path, exist_ok=True)
+        self._conn = sqlite3.connect(
+            os.path.join(path, "index.db"), timeout=60, check_same_thread=False
+        )
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embedding ("
+                "model TEXT, hash TEXT, slot INTEGER, accessed REAL, "
+                "PRIMARY KEY (model, hash))"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS embedding_accessed ON embedding(model, accessed)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS model ("
+                "model TEXT PRIMARY KEY, dim INTEGER, rows INTEGER)"
+            )
+
+    @contextlib.contextmanager
+    def _transaction(self, mode=""):
+        """Deferred (shared read) or EXCLUSIVE transaction, also exclusive over threads"""
+
+        with self._lock:
+            self._conn.execute("BEGIN " + mode)
+            try:
+                yield
+            except BaseException:
+                self._conn.rollback()
+                raise
+            self._conn.commit()
+
+    def _write_touched(self):
+        # caller holds an EXCLUSIVE transaction
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE embedding SET accessed = ? WHERE model = ? AND hash = ?",
+                [(t, m, h) for (m, h), t in self._touched.items()],
+            )
+            self._touched = {}
+
+    @staticmethod
+    def make_hash(kind, text):
+        return hashlib.sha256((kind + "\n" + text).encode("utf-8")).hexdigest()
+
+    def _file(self, model):
+        return os.path.join(
+            self.path, hashlib.sha1(model.encode("utf-8")).hexdigest()[:16] + ".f32"
+        )
+
+    def _model_info(self, model):
+        return self._conn.execute(
+            "SELECT dim, rows FROM model WHERE model = ?", (model,)
+        ).fetchone()
+
+    def _map(self, model, dim, rows):
+        """Vector file of the model mapped with at least rows rows"""
+
+        mapped = self._vectors.get(model)
+        if mapped is not None and mapped.shape[0] >= rows:
+            return mapped
+        file = self._file(model)
+        # 按 1024 行的粒度扩展文件，避免频繁重新映射
+        capacity = max(-(-rows // 1024) * 1024, 1024)
+        if mapped is not None:
+            mapped.flush()
+        with open(file, "ab") as f:
+            if f.tell() < capacity * dim * 4:
+                f.truncate(capacity * dim * 4)
+        mapped = np.memmap(file, dtype=np.float32, mode="r+", shape=(capacity, dim))
+        self._vectors[model] = mapped
+        return mapped
+
+    def get_many(self, model, kind, texts):
+        """Cached vectors of texts, None for every miss"""
+
+        hashes = [self.make_hash(kind, t) for t in texts]
+        with self._transaction():
+            info = self._model_info(model)
+            if not info:
+                return [None] * len(texts)
+            dim, rows = info
+            found = {}
+            for start in range(0, len(hashes), 500):
+                chunk = hashes[start : start + 500]
+                found.update(
+                    self._conn.execute(
+                        "SELECT hash, slot FROM embedding WHERE model = ? AND hash IN ({})".format(
+                            ",".join("?" * len(chunk))
+                        ),
+                        [model] + chunk,
+                    ).fetchall()
+                )
+            if not found:
+                return [None] * len(texts)
+            vectors = self._map(model, dim, rows)
+            results = [
+                vectors[found[h]].tolist() if h in found else None for h in hashes
+            ]
+            now = time.time()
+            for h in found:
+                self._touched[(model, h)] = now
+            touched = len(self._touched)
+        if touched >= 1024:
+            # 命中记录攒够一批再写，读路径不必每次都拿写锁
+            with self._transaction("EXCLUSIVE"):
+                self._write_touched()
+        return results
+
+    def put_many(self, model, kind, texts, embeddings):
+        entries = {self.make_hash(kind, t): e for t, e in zip(texts, embeddings)}
+        if not entries:
+            return
+        with self._transaction("EXCLUSIVE"):
+            self._write_touched()
+            dim = len(next(iter(entries.values())))
+            # 行数和槽位必须在事务内重新读取，其他进程可能刚写入过
+            info = self._model_info(model)
+            if info and info[0] != dim:
+                print(f"EmbeddingCache: dim of {model} changed {info[0]} -> {dim}, skip caching")
+                return
+            rows = info[1] if info else 0
+            existing = dict(
+                self._conn.execute(
+                    "SELECT hash, slot FROM embedding WHERE model = ? AND hash IN ({})".format(
+                        ",".join("?" * len(entries))
+                    ),
+                    [model] + list(entries.keys()),
+                ).fetchall()
+            )
+            new = [h for h in entries if h not in existing]
+            slots = dict(existing)
+            fresh = min(len(new), max(self.max_entries - rows, 0))
+            for h in new[:fresh]:
+                slots[h] = rows
+                rows += 1
+            evict = new[fresh:]
+            if evict:
+                # LRU: 用满后复用最久未访问的行
+                oldest = self._conn.execute(
+                    "SELECT hash, slot FROM embedding WHERE model = ? "
+                    "ORDER BY accessed LIMIT ?",
+                    (model, len(evict) + len(existing)),
+                ).fetchall()
+                oldest = [o for o in oldest if o[0] not in existing][: len(evict)]
+                self._conn.executemany(
+                    "DELETE FROM embedding WHERE model = ? AND hash = ?",
+                    [(model, h) for h, _ in oldest],
+                )
+                for h, (_, slot) in zip(evict, oldest):
+                    slots[h] = slot
+            vectors = self._map(model, dim, rows)
+            for h, slot in slots.items():
+                vectors[slot] = entries[h]
+            vectors.flush()
+            now = time.time()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embedding VALUES (?, ?, ?, ?)",
+                [(model, h, slot, now) for h, slot in slots.items()],
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO model VALUES (?, ?, ?)", (model, dim, rows)
+            )
+
+    def size(self, model=None):
+        with self._lock:
+            if model:
+                return self._conn.execute(
+                    "SELECT COUNT(*) FROM embedding WHERE model = ?", (model,)
+                ).fetchone()[0]
+            return self._conn.execute("SELECT COUNT(*) FROM embedding").fetchone()[0]
+
+
+def get_embedding_cache(cache_config):
+    """Get the shared embedding cache, None if the cache is not enabled"""
+
+    if not cache_config or not cache_config.get("enable", False):
+        return None
+    path = cache_config.get("path", "results/embedding_cache")
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = EmbeddingCache(**cache_config)
+        return _caches[path]
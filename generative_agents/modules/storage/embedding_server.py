@@ -0,0 +1,269 @@
+"""generative_agents.storage.embedding_server
+
+Local embedding service shared by concurrent experiments, start it with:
+    python -m modules.storage.embedding_server --model sentence-transformers/all-MiniLM-L6-v2
+and set the embedding provider of data/config.json to "local_service".
+"""
+
+import os
+import json
+import time
+import queue
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+from typing import List
+
+import numpy as np
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+DEFAULT_ADDRESS = "unix:/tmp/generative_agents_embedding.sock"
+_MAX_FRAME = 64 * 1024 * 1024
+
+
+def _parse_address(address):
+    """unix:/path/to.sock or host:port -> (family, address)"""
+
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+    host, port = address.rsplit(":", 1)
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+
+def _send_frame(sock, data):
+    sock.sendall(struct.pack(">I", len(data)) + data)
+
+
+def _recv_exact(sock, size):
+    chunks, left = [], size
+    while left:
+        chunk = sock.recv(min(left, 1 << 20))
+        if not chunk:
+            raise ConnectionError("embedding service closed the connection")
+        chunks.append(chunk)
+        left -= len(chunk)
+    return b"".join(chunks)
+
+
+def _recv_frame(sock):
+    size = struct.unpack(">I", _recv_exact(sock, 4))[0]
+    if size > _MAX_FRAME:
+        raise ValueError("embedding service frame too large: {}".format(size))
+    return _recv_exact(sock, size)
+
+
+class _Request:
+    def __init__(self, kind, texts):
+        self.kind = kind
+        self.texts = texts
+        self.vectors = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class EmbeddingBatcher:
+    """Coalesce the requests of all clients into batches of the loaded model
+
+    A batch closes once it holds batch_size texts or max_wait seconds passed since
+    its first request arrived.
+    """
+
+    def __init__(self, embed_model, batch_size=64, max_wait=0.01):
+        self.embed_model = embed_model
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self.stats = {"requests": 0, "texts": 0, "batches": 0}
+        threading.Thread(target=self._work, daemon=True).start()
+
+    def embed(self, kind, texts):
+        request = _Request(kind, texts)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error:
+            raise request.error
+        return request.vectors
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        size, deadline = len(batch[0].texts), time.time() + self.max_wait
+        while size < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.texts)
+        return batch
+
+    def _work(self):
+        while True:
+            batch = self._collect()
+            self.stats["requests"] += len(batch)
+            self.stats["batches"] += 1
+            for kind in ("text", "query"):
+                requests = [r for r in batch if r.kind == kind]
+                if not requests:
+                    continue
+                texts = [t for r in requests for t in r.texts]
+                self.stats["texts"] += len(texts)
+                try:
+                    if kind == "text":
+                        vectors = self.embed_model.get_text_embedding_batch(texts)
+                    else:
+                        vectors = [self.embed_model.get_query_embedding(t) for t in texts]
+                    vectors = np.asarray(vectors, dtype=np.float32)
+                except Exception as e:
+                    for request in requests:
+                        request.error = e
+                        request.done.set()
+                    continue
+                start = 0
+                for request in requests:
+                    request.vectors = vectors[start : start + len(request.texts)]
+                    start += len(request.texts)
+                    request.done.set()
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        while True:
+            try:
+                request = json.loads(_recv_frame(self.request).decode("utf-8"))
+            except (ConnectionError, OSError, ValueError):
+                return
+            try:
+                if request.get("model") and request["model"] != server.model_name:
+                    raise ValueError(
+                        "embedding service serves {}, not {}".format(
+                            server.model_name, request["model"]
+                        )
+                    )
+                if request.get("kind") == "stats":
+                    header, payload = {"stats": server.batcher.stats}, b""
+                else:
+                    vectors = server.batcher.embed(request.get("kind", "text"), request["texts"])
+                    header = {"count": vectors.shape[0], "dim": vectors.shape[1]}
+                    payload = vectors.tobytes()
+            except Exception as e:
+                header, payload = {"error": "{}: {}".format(type(e).__name__, e)}, b""
+            try:
+                _send_frame(self.request, json.dumps(header).encode("utf-8"))
+                _send_frame(self.request, payload)
+            except OSError:
+                return
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(embedding_config, address=DEFAULT_ADDRESS, batch_size=64, max_wait=0.01):
+    """Load the model once and serve it until interrupted"""
+
+    from .embedding import _create_embedding
+
+    family, addr = _parse_address(address)
+    embed_model = _create_embedding(embedding_config)
+    if family == socket.AF_UNIX:
+        if os.path.exists(addr):
+            os.remove(addr)
+        server = _UnixServer(addr, _Handler)
+    else:
+        server = _TCPServer(addr, _Handler)
+    server.model_name = embedding_config["model"]
+    server.batcher = EmbeddingBatcher(embed_model, batch_size, max_wait)
+    print(f"embedding service: {embedding_config['model']} listening on {address}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.remove(addr)
+
+
+class ServiceEmbedding(BaseEmbedding):
+    """Client of the local embedding service, one connection per thread"""
+
+    address: str = DEFAULT_ADDRESS
+    timeout: float = 120.0
+    _local: threading.local = PrivateAttr(default_factory=threading.local)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ServiceEmbedding"
+
+    def _connection(self):
+        local = self._local
+        if getattr(local, "sock", None) is None:
+            family, addr = _parse_address(self.address)
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(addr)
+            except OSError as e:
+                sock.close()
+                raise ConnectionError(
+                    "embedding service is not running at {} ({}), start it with "
+                    "python -m modules.storage.embedding_server".format(self.address, e)
+                )
+            local.sock = sock
+        return local
+
+    def _request(self, kind, texts):
+        local = self._connection()
+        try:
+            data = json.dumps({"model": self.model_name, "kind": kind, "texts": texts})
+            _send_frame(local.sock, data.encode("utf-8"))
+            header = json.loads(_recv_frame(local.sock).decode("utf-8"))
+            payload = _recv_frame(local.sock)
+        except (OSError, ValueError):
+            # 连接断开后下次请求重新连接
+            local.sock.close()
+            local.sock = None
+            raise
+        if "error" in header:
+            raise RuntimeError("embedding service error: " + header["error"])
+        vectors = np.frombuffer(payload, dtype=np.float32)
+        return vectors.reshape(header["count"], header["dim"]).tolist()
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._request("query", [query])[0]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._request("text", [text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._request("text", texts)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="generative_agents embedding service")
+    parser.add_argument("--provider", type=str, default="hugging_face", help="被服务的embedding provider")
+    parser.add_argument("--model", type=str, default="sentence-transformers/all-MiniLM-L6-v2", help="embedding模型")
+    parser.add_argument("--address", type=str, default=DEFAULT_ADDRESS, help="unix:/path/to.sock 或 host:port")
+    parser.add_argument("--batch-size", type=int, default=64, help="每批最多合并的文本数")
+    parser.add_argument("--max-wait", type=float, default=0.01, help="凑批的最长等待时间（秒）")
+    args = parser.parse_args()
+
+    serve(
+        {"provider": args.provider, "model": args.model},
+        address=args.address,
+        batch_size=args.batch_size,
+        max_wait=args.max_wait,
+    )
@@ -1,61 +1,34 @@
 """generative_agents.storage.index"""
 
 import os
-import time
-import threading
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 from llama_index.core.indices.vector_store.retrievers import VectorIndexRetriever
 from llama_index.core.schema import TextNode
 from llama_index import core as index_core
-from llama_index.embeddings.ollama import OllamaEmbedding
-from llama_index.embeddings.openai import OpenAIEmbedding
-from llama_index.core.node_parser import SentenceSplitter
-from llama_index.core import Settings
 
 from modules import utils
-
-# 全局速率限制器：避免并发请求导致 Ollama 502 错误
-_embedding_lock = threading.Lock()
-_last_embedding_time = 0
-_min_embedding_interval = 0.3  # 每次 embedding 请求最少间隔 0.3 秒
+from .embedding import get_embedding, get_embedding_queue
 
 
 class LlamaIndex:
     def __init__(self, embedding_config, path=None):
         self._config = {"max_nodes": 0}
-        if embedding_config["provider"] == "hugging_face":
-            embed_model = HuggingFaceEmbedding(model_name=embedding_config["model"])
-        elif embedding_config["provider"] == "ollama":
-            embed_model = OllamaEmbedding(
-                model_name=embedding_config["model"],
-                base_url=embedding_config["base_url"],
-                ollama_additional_kwargs={"mirostat": 0},
-                request_timeout=120.0,  # 增加超时到120秒
-            )
-        elif embedding_config["provider"] == "openai":
-            embed_model = OpenAIEmbedding(
-                model_name=embedding_config["model"],
-                api_base=embedding_config["base_url"],
-                api_key=embedding_config["api_key"],
-            )
-        else:
-            raise NotImplementedError(
-                "embedding provider {} is not supported".format(embedding_config["provider"])
-            )
-
-        Settings.embed_model = embed_model
-        Settings.node_parser = SentenceSplitter(chunk_size=512, chunk_overlap=64)
-        Settings.num_output = 1024
-        Settings.context_window = 4096
+        self._retry_policy = utils.RetryPolicy(**embedding_config.get("retry", {}))
+        self._endpoint = embedding_config.get("base_url") or embedding_config["provider"]
+        # 模型和批量队列按配置共享，不再修改 llama_index 的全局 Settings
+        self._embed_model = get_embedding(embedding_config)
         if path and os.path.exists(path):
             self._index = index_core.load_index_from_storage(
                 index_core.StorageContext.from_defaults(persist_dir=path),
+                embed_model=self._embed_model,
                 show_progress=True,
             )
             self._config = utils.load_dict(os.path.join(path, "index_config.json"))
         else:
-            self._index = index_core.VectorStoreIndex([], show_progress=True)
+            self._index = index_core.VectorStoreIndex(
+                [], embed_model=self._embed_model, show_progress=True
+            )
         self._path = path
+        self._queue = get_embedding_queue(embedding_config)
 
     def add_node(
         self,
@@ -65,56 +38,40 @@ class LlamaIndex:
         exclude_embedding_keys=None,
         id=None,
     ):
-        global _embedding_lock, _last_embedding_time, _min_embedding_interval
-        
-        max_retries = 5
-        retry_count = 0
-        base_delay = 2
-        
-        while retry_count < max_retries:
-            try:
-                # 使用全局锁确保 embedding 请求串行化，避免并发冲突
-                with _embedding_lock:
-                    # 确保两次请求之间有最小间隔
-                    current_time = time.time()
-                    time_since_last = current_time - _last_embedding_time
-                    if time_since_last < _min_embedding_interval:
-                        time.sleep(_min_embedding_interval - time_since_last)
-                    
-                    metadata = metadata or {}
-                    exclude_llm_keys = exclude_llm_keys or list(metadata.keys())
-                    exclude_embedding_keys = exclude_embedding_keys or list(metadata.keys())
-                    id = id or "node_" + str(self._config["max_nodes"])
-                    self._config["max_nodes"] += 1
-                    node = TextNode(
-                        text=text,
-                        id_=id,
-                        metadata=metadata,
-                        excluded_llm_metadata_keys=exclude_llm_keys,
-                        excluded_embed_metadata_keys=exclude_embedding_keys,
-                    )
-                    self._index.insert_nodes([node])
-                    _last_embedding_time = time.time()
-                    
-                return node
-            except Exception as e:
-                retry_count += 1
-                if retry_count >= max_retries:
-                    print(f"LlamaIndex.add_node() 失败（已重试 {max_retries} 次）: {e}")
-                    raise e
-                
-                # 指数退避：等待时间逐渐增加
-                wait_time = base_delay * (2 ** (retry_count - 1))
-                print(f"LlamaIndex.add_node() 错误 ({retry_count}/{max_retries}): {e}, {wait_time}秒后重试...")
-                time.sleep(wait_time)
+        metadata = metadata or {}
+        exclude_llm_keys = exclude_llm_keys or list(metadata.keys())
+        exclude_embedding_keys = exclude_embedding_keys or list(metadata.keys())
+        id = id or "node_" + str(self._config["max_nodes"])
+        self._config["max_nodes"] += 1
+        node = TextNode(
+            text=text,
+            id_=id,
+            metadata=metadata,
+            excluded_llm_metadata_keys=exclude_llm_keys,
+            excluded_embed_metadata_keys=exclude_embedding_keys,
+        )
+        # 节点先入队，批量计算 embedding 后再写入索引
+        self._queue.put(node, self._insert_nodes)
+        return node
+
+    def _insert_nodes(self, nodes, vectors):
+        for node, vector in zip(nodes, vectors):
+            node.embedding = vector
+        self._index.insert_nodes(nodes)
+
+    def flush(self):
+        self._queue.flush(self._insert_nodes)
 
     def has_node(self, node_id):
+        self.flush()
         return node_id in self._index.docstore.docs
 
     def find_node(self, node_id):
+        self.flush()
         return self._index.docstore.docs[node_id]
 
     def get_nodes(self, filter=None):
+        self.flush()
         def _check(node):
             if not filter:
                 return True
@@ -123,9 +80,11 @@ class LlamaIndex:
         return [n for n in self._index.docstore.docs.values() if _check(n)]
 
     def remove_nodes(self, node_ids, delete_from_docstore=True):
+        self.flush()
         self._index.delete_nodes(node_ids, delete_from_docstore=delete_from_docstore)
 
     def cleanup(self):
+        self.flush()
         now, remove_ids = utils.get_timer().get_date(), []
         for node_id, node in self._index.docstore.docs.items():
             create = utils.to_date(node.metadata["create"])
@@ -143,6 +102,7 @@ class LlamaIndex:
         node_ids=None,
         retriever_creator=None,
     ):
+        self.flush()
         try:
             retriever_creator = retriever_creator or VectorIndexRetriever
             return retriever_creator(
@@ -170,22 +130,43 @@ class LlamaIndex:
             "refine_template": refine_template,
             "filters": filters,
         }
-        while True:
-            try:
-                if query_creator:
-                    query_engine = query_creator(retriever=self._index.as_retriever(**kwargs))
-                else:
-                    query_engine = self._index.as_query_engine(**kwargs)
-                return query_engine.query(text)
-            except Exception as e:
-                print(f"LlamaIndex.query() caused an error: {e}")
-                time.sleep(5)
+
+        self.flush()
+
+        def _query():
+            if query_creator:
+                query_engine = query_creator(retriever=self._index.as_retriever(**kwargs))
+            else:
+                query_engine = self._index.as_query_engine(**kwargs)
+            return query_engine.query(text)
+
+        return self._retry_policy.call(
+            _query, endpoint=self._endpoint, name="LlamaIndex.query()"
+        )
 
     def save(self, path=None):
+        self.flush()
         path = path or self._path
         self._index.storage_context.persist(path)
         utils.save_dict(self._config, os.path.join(path, "index_config.json"))
 
+    @property
+    def embed_model(self):
+        return self._embed_model
+
     @property
     def nodes_num(self):
+        self.flush()
         return len(self._index.docstore.docs)
+
+
+def create_index(embedding_config, path=None, vector_store="llama_index"):
+    """Create the vector index of the backend, llama_index or numpy"""
+
+    if vector_store == "llama_index":
+        return LlamaIndex(embedding_config, path)
+    if vector_store == "numpy":
+        from .numpy_index import NumpyIndex
+
+        return NumpyIndex(embedding_config, path)
+    raise NotImplementedError("vector store {} is not supported".format(vector_store))
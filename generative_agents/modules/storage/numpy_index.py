@@ -0,0 +1,239 @@
+"""generative_agents.storage.numpy_index"""
+
+import os
+import json
+
+import numpy as np
+from llama_index.core.schema import TextNode, NodeWithScore
+
+from modules import utils
+from .embedding import get_embedding, get_embedding_queue
+
+
+class NumpyIndex:
+    """In-memory vector store with the surface of LlamaIndex
+
+    Embeddings live in one contiguous float32 matrix (rows are L2 normalized) next to
+    a parallel list of nodes. Retrieval is a single matrix-vector product, node_ids
+    and metadata filters become boolean masks and top-k is taken by argpartition.
+    Removed rows are only masked out and compacted once they are the majority.
+    """
+
+    def __init__(self, embedding_config, path=None):
+        self._config = {"max_nodes": 0}
+        self._embed_model = get_embedding(embedding_config)
+        self._nodes = []
+        self._rows = {}
+        self._vectors = None
+        self._alive = np.zeros(0, dtype=bool)
+        self._path = path
+        self._queue = get_embedding_queue(embedding_config)
+        if path and os.path.exists(os.path.join(path, "vectors.npy")):
+            self._load(path)
+        elif path and os.path.exists(os.path.join(path, "docstore.json")):
+            self._load_llama_index(path)
+
+    def _load(self, path):
+        self._config = utils.load_dict(os.path.join(path, "index_config.json"))
+        nodes = utils.load_dict(os.path.join(path, "nodes.json"))
+        vectors = np.load(os.path.join(path, "vectors.npy"))
+        self._nodes = [
+            TextNode(
+                text=n["text"],
+                id_=n["id"],
+                metadata=n["metadata"],
+                excluded_llm_metadata_keys=list(n["metadata"].keys()),
+                excluded_embed_metadata_keys=list(n["metadata"].keys()),
+            )
+            for n in nodes
+        ]
+        self._rows = {n.id_: i for i, n in enumerate(self._nodes)}
+        self._vectors = vectors.astype(np.float32)
+        self._alive = np.ones(len(self._nodes), dtype=bool)
+
+    def _load_llama_index(self, path):
+        """Migrate a storage folder persisted by LlamaIndex"""
+
+        from llama_index import core as index_core
+
+        index = index_core.load_index_from_storage(
+            index_core.StorageContext.from_defaults(persist_dir=path),
+            embed_model=self._embed_model,
+        )
+        config_file = os.path.join(path, "index_config.json")
+        if os.path.exists(config_file):
+            self._config = utils.load_dict(config_file)
+        for node in index.docstore.docs.values():
+            try:
+                vector = index.vector_store.get(node.id_)
+            except KeyError:
+                vector = None
+            self._append(node, vector or self._embed_model.get_text_embedding(node.text))
+
+    def _append(self, node, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector = vector / norm
+        row = len(self._nodes)
+        if self._vectors is None or not self._vectors.size:
+            self._vectors = np.zeros((16, vector.shape[0]), dtype=np.float32)
+            self._alive = np.zeros(16, dtype=bool)
+        elif row >= self._vectors.shape[0]:
+            # 容量翻倍，保持矩阵连续
+            capacity = self._vectors.shape[0] * 2
+            self._vectors = np.resize(self._vectors, (capacity, self._vectors.shape[1]))
+            self._alive = np.concatenate([self._alive, np.zeros(capacity - row, dtype=bool)])
+        self._vectors[row] = vector
+        self._alive[row] = True
+        self._nodes.append(node)
+        self._rows[node.id_] = row
+
+    def add_node(
+        self,
+        text,
+        metadata=None,
+        exclude_llm_keys=None,
+        exclude_embedding_keys=None,
+        id=None,
+    ):
+        metadata = metadata or {}
+        exclude_llm_keys = exclude_llm_keys or list(metadata.keys())
+        exclude_embedding_keys = exclude_embedding_keys or list(metadata.keys())
+        id = id or "node_" + str(self._config["max_nodes"])
+        self._config["max_nodes"] += 1
+        node = TextNode(
+            text=text,
+            id_=id,
+            metadata=metadata,
+            excluded_llm_metadata_keys=exclude_llm_keys,
+            excluded_embed_metadata_keys=exclude_embedding_keys,
+        )
+        # 节点先入队，批量计算 embedding 后再写入矩阵
+        self._queue.put(node, self._insert_nodes)
+        return node
+
+    def _insert_nodes(self, nodes, vectors):
+        for node, vector in zip(nodes, vectors):
+            if node.id_ in self._rows:
+                self._remove(node.id_)
+            self._append(node, vector)
+
+    def flush(self):
+        self._queue.flush(self._insert_nodes)
+
+    def has_node(self, node_id):
+        self.flush()
+        return node_id in self._rows
+
+    def find_node(self, node_id):
+        self.flush()
+        return self._nodes[self._rows[node_id]]
+
+    def get_nodes(self, filter=None):
+        self.flush()
+        nodes = [self._nodes[r] for r in self._rows.values()]
+        if not filter:
+            return nodes
+        return [n for n in nodes if filter(n)]
+
+    def _remove(self, node_id):
+        row = self._rows.pop(node_id, None)
+        if row is not None:
+            self._alive[row] = False
+
+    def remove_nodes(self, node_ids, delete_from_docstore=True):
+        self.flush()
+        for node_id in node_ids:
+            self._remove(node_id)
+        if len(self._nodes) > 16 and len(self._rows) < len(self._nodes) / 2:
+            self._compact()
+
+    def _compact(self):
+        rows = np.flatnonzero(self._alive[: len(self._nodes)])
+        self._vectors = np.ascontiguousarray(self._vectors[rows])
+        self._nodes = [self._nodes[r] for r in rows]
+        self._rows = {n.id_: i for i, n in enumerate(self._nodes)}
+        self._alive = np.ones(len(self._nodes), dtype=bool)
+
+    def cleanup(self):
+        self.flush()
+        now, remove_ids = utils.get_timer().get_date(), []
+        for node_id, row in self._rows.items():
+            node = self._nodes[row]
+            create = utils.to_date(node.metadata["create"])
+            expire = utils.to_date(node.metadata["expire"])
+            if create > now or expire < now:
+                remove_ids.append(node_id)
+        self.remove_nodes(remove_ids)
+        return remove_ids
+
+    def _mask(self, filters=None, node_ids=None):
+        if node_ids is not None:
+            mask = np.zeros(len(self._nodes), dtype=bool)
+            rows = [self._rows[n] for n in node_ids if n in self._rows]
+            mask[rows] = True
+        else:
+            mask = self._alive[: len(self._nodes)].copy()
+        for f in filters.filters if filters else []:
+            candidates = np.flatnonzero(mask)
+            keep = [r for r in candidates if self._nodes[r].metadata.get(f.key) == f.value]
+            mask[:] = False
+            mask[keep] = True
+        return mask
+
+    def retrieve(
+        self,
+        text,
+        similarity_top_k=5,
+        filters=None,
+        node_ids=None,
+        retriever_creator=None,
+    ):
+        """Top-k nodes by cosine similarity, retriever_creator is not supported"""
+
+        self.flush()
+        try:
+            mask = self._mask(filters, node_ids)
+            rows = np.flatnonzero(mask)
+            if not len(rows) or similarity_top_k <= 0:
+                return []
+            query = np.asarray(self._embed_model.get_query_embedding(text), dtype=np.float32)
+            norm = np.linalg.norm(query)
+            scores = self._vectors[rows] @ (query / norm if norm else query)
+            k = min(similarity_top_k, len(rows))
+            top = np.argpartition(-scores, k - 1)[:k] if k < len(rows) else np.arange(len(rows))
+            top = top[np.argsort(-scores[top])]
+            return [
+                NodeWithScore(node=self._nodes[rows[i]], score=float(scores[i])) for i in top
+            ]
+        except Exception as e:
+            # print(f"NumpyIndex.retrieve() caused an error: {e}")
+            return []
+
+    def save(self, path=None):
+        self.flush()
+        path = path or self._path
+        os.makedirs(path, exist_ok=True)
+        rows = [self._rows[n] for n in self._rows]
+        nodes = [
+            {"id": self._nodes[r].id_, "text": self._nodes[r].text, "metadata": self._nodes[r].metadata}
+            for r in rows
+        ]
+        with open(os.path.join(path, "nodes.json"), "w", encoding="utf-8") as f:
+            json.dump(nodes, f, ensure_ascii=False)
+        if self._vectors is None:
+            vectors = np.zeros((0, 0), dtype=np.float32)
+        else:
+            vectors = self._vectors[rows]
+        np.save(os.path.join(path, "vectors.npy"), vectors)
+        utils.save_dict(self._config, os.path.join(path, "index_config.json"))
+
+    @property
+    def embed_model(self):
+        return self._embed_model
+
+    @property
+    def nodes_num(self):
+        self.flush()
+        return len(self._rows)
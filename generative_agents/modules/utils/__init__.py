@@ -1,6 +1,8 @@
 """generative_agents.utils"""
 
 from .arguments import *
+from .json_repair import *
 from .log import *
 from .namespace import *
+from .retry import *
 from .timer import *
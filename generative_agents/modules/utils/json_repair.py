@@ -0,0 +1,204 @@
+"""generative_agents.utils.json_repair"""
+
+import json
+
+_OPEN_QUOTES = {'"': '"', "“": "”", "”": "”", "＂": "＂"}
+_CLOSE_QUOTES = set('"”＂')
+_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f", "/": "/", "\\": "\\", '"': '"'}
+
+
+def _set_field(obj, key, value):
+    # 重复的键保留最后一个非空的值
+    if key in obj and value in (None, ""):
+        return
+    obj[key] = value
+
+
+def _object_pairs(pairs):
+    obj = {}
+    for key, value in pairs:
+        _set_field(obj, key, value)
+    return obj
+
+
+class _LenientParser:
+    """Single pass parser that keeps going where json.loads gives up"""
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+        self.repairs = []
+        self._field_repaired = False
+
+    def _repair(self, kind):
+        self._field_repaired = True
+        if kind not in self.repairs:
+            self.repairs.append(kind)
+
+    def _skip(self, chars=" \t\r\n"):
+        while self.pos < len(self.text) and self.text[self.pos] in chars:
+            self.pos += 1
+
+    def _peek(self):
+        return self.text[self.pos] if self.pos < len(self.text) else ""
+
+    def parse_object(self, top=False):
+        # self.pos is right after "{"
+        obj, salvaged = {}, []
+        while True:
+            self._skip(" \t\r\n,")
+            char = self._peek()
+            if not char:
+                self._repair("missing closing brace")
+                return obj, salvaged
+            if char == "}":
+                self.pos += 1
+                return obj, salvaged
+            self._field_repaired = False
+            key = self._parse_key()
+            self._skip()
+            if self._peek() == ":" or self._peek() == "：":
+                self.pos += 1
+                value = self.parse_value()
+            else:
+                self._repair("missing value")
+                value = None
+            if key in obj:
+                self._repair("duplicate key")
+            _set_field(obj, key, value)
+            if top and self._field_repaired and key not in salvaged:
+                salvaged.append(key)
+
+    def _parse_key(self):
+        if self._peek() in _OPEN_QUOTES:
+            return self._parse_string()
+        start = self.pos
+        while self.pos < len(self.text) and self.text[self.pos] not in ":：}\n":
+            self.pos += 1
+        self._repair("unquoted key")
+        return self.text[start:self.pos].strip()
+
+    def parse_value(self):
+        self._skip()
+        char = self._peek()
+        if char == "{":
+            self.pos += 1
+            return self.parse_object()[0]
+        if char == "[":
+            self.pos += 1
+            return self._parse_array()
+        if char in _OPEN_QUOTES:
+            return self._parse_string()
+        if not char:
+            self._repair("truncated value")
+            return None
+        return self._parse_literal()
+
+    def _parse_array(self):
+        items = []
+        while True:
+            self._skip(" \t\r\n,")
+            char = self._peek()
+            if not char:
+                self._repair("missing closing bracket")
+                return items
+            if char == "]":
+                self.pos += 1
+                return items
+            if char == "}":
+                self._repair("missing closing bracket")
+                return items
+            items.append(self.parse_value())
+
+    def _parse_literal(self):
+        start = self.pos
+        while self.pos < len(self.text) and self.text[self.pos] not in ",}]\n":
+            self.pos += 1
+        raw = self.text[start:self.pos].strip()
+        try:
+            return json.loads(raw)
+        except ValueError:
+            self._repair("bare value")
+            return raw
+
+    def _is_closing(self, idx):
+        # a quote closes the string only if followed by a structural character
+        idx += 1
+        while idx < len(self.text) and self.text[idx] in " \t\r\n":
+            idx += 1
+        if idx >= len(self.text) or self.text[idx] in ":}]":
+            return True
+        if self.text[idx] != ",":
+            return False
+        idx += 1
+        while idx < len(self.text) and self.text[idx] in " \t\r\n":
+            idx += 1
+        return idx >= len(self.text) or self.text[idx] in '"“”＂}]{[' or self.text[idx].isdigit()
+
+    def _parse_string(self):
+        quote = self.text[self.pos]
+        if quote != '"':
+            self._repair("smart quotes")
+        closing = _CLOSE_QUOTES | {_OPEN_QUOTES[quote]}
+        self.pos += 1
+        chars = []
+        while self.pos < len(self.text):
+            char = self.text[self.pos]
+            if char == "\\" and self.pos + 1 < len(self.text):
+                nxt = self.text[self.pos + 1]
+                if nxt == "u" and self.pos + 6 <= len(self.text):
+                    try:
+                        chars.append(chr(int(self.text[self.pos + 2:self.pos + 6], 16)))
+                        self.pos += 6
+                        continue
+                    except ValueError:
+                        pass
+                chars.append(_ESCAPES.get(nxt, nxt))
+                self.pos += 2
+                continue
+            if char in closing:
+                if self._is_closing(self.pos):
+                    self.pos += 1
+                    return "".join(chars)
+                self._repair("unescaped quote")
+            chars.append(char)
+            self.pos += 1
+        self._repair("truncated string")
+        return "".join(chars)
+
+
+def _strip_fence(text):
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        if "```" in text:
+            text = text.rsplit("```", 1)[0]
+    return text
+
+
+def load_json_lenient(text):
+    """Extract and parse the first JSON object of an llm response
+
+    Returns (dict, report), report lists the "repairs" that were applied and the
+    top level fields that were "salvaged" by them. Raises ValueError if the
+    response holds no object at all.
+    """
+
+    text = _strip_fence(text or "")
+    start = text.find("{")
+    if start < 0:
+        raise ValueError("LLM output缺少JSON结构：" + text[:200])
+    end = text.rfind("}")
+    if end > start:
+        try:
+            data = json.loads(text[start:end + 1], strict=False, object_pairs_hook=_object_pairs)
+            if isinstance(data, dict):
+                return data, {"repairs": [], "salvaged": []}
+        except ValueError:
+            pass
+    parser = _LenientParser(text)
+    parser.pos = start + 1
+    data, salvaged = parser.parse_object(top=True)
+    if not data:
+        raise ValueError("LLM output不是合法JSON：" + text[:200])
+    return data, {"repairs": parser.repairs, "salvaged": salvaged}
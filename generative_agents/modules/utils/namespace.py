@@ -42,3 +42,4 @@ class GenerativeAgentsKey:
     GAME = "game"
     TIMER = "timer"
     MODELS = "models"
+    RETRY_BUDGET = "retry_budget"
@@ -0,0 +1,165 @@
+"""generative_agents.utils.retry"""
+
+import time
+import random
+import threading
+
+from .namespace import GenerativeAgentsMap, GenerativeAgentsKey
+
+
+def classify_error(error):
+    """Classify a request error as rate_limit| server| client| transport"""
+
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if not isinstance(status, int):
+        return "transport"
+    if status == 429:
+        return "rate_limit"
+    if status >= 500:
+        return "server"
+    if status >= 400:
+        return "client"
+    return "transport"
+
+
+class CircuitBreaker:
+    """Per-endpoint breaker, fails fast while the backend keeps failing"""
+
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened is None:
+                return True
+            # half-open: let one probe through after the cooldown
+            if time.time() - self._opened >= self.cooldown:
+                self._opened = time.time()
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self._failures, self._opened = 0, None
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.threshold:
+                self._opened = time.time()
+
+    @property
+    def is_open(self):
+        return self._opened is not None
+
+
+class RetryBudget:
+    """Total retries allowed for one experiment, negative for unlimited"""
+
+    def __init__(self, total=-1):
+        self.total = total
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def consume(self):
+        with self._lock:
+            if 0 <= self.total <= self.used:
+                return False
+            self.used += 1
+            return True
+
+
+class RetryPolicy:
+    """Jittered exponential backoff, parse errors are retried without sleeping"""
+
+    def __init__(
+        self,
+        max_retry=10,
+        base_delay=1,
+        max_delay=30,
+        rate_limit_delay=5,
+        jitter=0.5,
+        breaker_threshold=5,
+        breaker_cooldown=30,
+    ):
+        self.max_retry = max_retry
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rate_limit_delay = rate_limit_delay
+        self.jitter = jitter
+        self.breaker_config = {
+            "threshold": breaker_threshold,
+            "cooldown": breaker_cooldown,
+        }
+
+    def delay(self, attempt, kind="transport"):
+        if kind == "parse":
+            return 0
+        base = self.rate_limit_delay if kind in ("rate_limit", "server") else self.base_delay
+        delay = min(self.max_delay, base * (2**attempt))
+        return delay * (1 - self.jitter * random.random())
+
+    def allow_retry(self, attempt, retry=None):
+        retry = retry or self.max_retry
+        if attempt + 1 >= retry:
+            return False
+        return get_retry_budget().consume()
+
+    def breaker(self, endpoint):
+        return get_circuit_breaker(endpoint, **self.breaker_config)
+
+    def call(self, func, *args, endpoint=None, name="", **kwargs):
+        """Call func with retries, raise the last error when retries run out"""
+
+        breaker = self.breaker(endpoint) if endpoint else None
+        attempt = 0
+        while True:
+            if breaker and not breaker.allow():
+                raise RuntimeError("circuit open for " + str(endpoint))
+            try:
+                ret = func(*args, **kwargs)
+                if breaker:
+                    breaker.success()
+                return ret
+            except Exception as e:
+                kind = classify_error(e)
+                if breaker and kind != "client":
+                    breaker.failure()
+                if not self.allow_retry(attempt):
+                    raise e
+                delay = self.delay(attempt, kind)
+                print(
+                    "{} caused a {} error ({}/{}): {}, retry in {:.1f}s".format(
+                        name or func.__name__, kind, attempt + 1, self.max_retry, e, delay
+                    )
+                )
+                time.sleep(delay)
+                attempt += 1
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(endpoint, **kwargs):
+    with _breakers_lock:
+        if endpoint not in _breakers:
+            _breakers[endpoint] = CircuitBreaker(**kwargs)
+        return _breakers[endpoint]
+
+
+def set_retry_budget(total=-1):
+    GenerativeAgentsMap.set(GenerativeAgentsKey.RETRY_BUDGET, RetryBudget(total))
+    return GenerativeAgentsMap.get(GenerativeAgentsKey.RETRY_BUDGET)
+
+
+def get_retry_budget():
+    if not GenerativeAgentsMap.get(GenerativeAgentsKey.RETRY_BUDGET):
+        set_retry_budget()
+    return GenerativeAgentsMap.get(GenerativeAgentsKey.RETRY_BUDGET)
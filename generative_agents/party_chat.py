@@ -3,7 +3,10 @@
 支持：情景感知、中文思考、Novlang翻译、理解验证、多轮对话
 """
 import os
+import re
 import json
+import math
+import hashlib
 import copy
 import random
 import argparse
@@ -11,6 +14,7 @@ import datetime
 from dotenv import load_dotenv, find_dotenv
 
 from modules.game import create_game, get_game
+from modules.model.telemetry import estimate_tokens
 from modules import utils
 
 # 语言涌现实验的四个核心角色
@@ -37,6 +41,146 @@ class GroupListener:
     def get_event(self):
         return self._event
 
+class ConversationWindow:
+    """
+    对话历史窗口：最近 keep_turns 个回合保留原文，更早的回合折叠进滚动摘要
+    每累计 summary_every 个回合增量更新一次摘要，超出 token_budget 时提前折叠
+    """
+
+    def __init__(self, keep_turns=6, summary_every=4, token_budget=1200):
+        self.keep_turns = keep_turns
+        self.summary_every = max(summary_every, 1)
+        self.token_budget = token_budget
+        self.summary = ""
+        self.folded = 0
+        self.history_tokens = []
+        self.summaries = 0
+
+    @staticmethod
+    def _entry_tokens(entry):
+        return (
+            estimate_tokens(entry.get("speaker", ""))
+            + estimate_tokens(entry.get("novlang", ""))
+            + estimate_tokens(entry.get("chinese", ""))
+            + 4
+        )
+
+    def _tokens(self, entries):
+        return estimate_tokens(self.summary) + sum(self._entry_tokens(e) for e in entries)
+
+    def update(self, history, summarizer):
+        """折叠到期的旧回合，返回仍保留原文的回合"""
+        recent = history[self.folded:]
+        fold = len(recent) - self.keep_turns
+        if fold < self.summary_every:
+            fold = 0
+        if self.token_budget > 0:
+            # 超出预算时，即使未到摘要周期也继续折叠最旧的回合（至少保留一个）
+            while fold < len(recent) - 1 and self._tokens(recent[fold:]) > self.token_budget:
+                fold += 1
+        if fold > 0:
+            self.summary = summarizer(self.summary, recent[:fold])
+            self.summaries += 1
+            self.folded += fold
+            recent = recent[fold:]
+        self.history_tokens.append(self._tokens(recent))
+        return recent
+
+    def abstract(self):
+        tokens = self.history_tokens or [0]
+        return {
+            "token_budget": self.token_budget,
+            "keep_turns": self.keep_turns,
+            "summary_every": self.summary_every,
+            "folded_turns": self.folded,
+            "summaries": self.summaries,
+            "history_tokens": {"max": max(tokens), "total": sum(tokens)},
+        }
+
+
+class KnowledgeStore:
+    """
+    注入知识的向量索引：按段落切块，每个回合只取与当前情境最相关的 top_k 块
+    相同内容重复注入时只保留一份，注入到上下文的文本不超过 token_budget
+    """
+
+    def __init__(self, embed_model, top_k=3, token_budget=400, chunk_tokens=120):
+        self.embed_model = embed_model
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self.chunk_tokens = chunk_tokens
+        self.chunks = []
+        self._hashes = set()
+
+    def _split(self, text):
+        chunks = []
+        for para in re.split(r"\n\s*\n", text):
+            para = para.strip()
+            if not para:
+                continue
+            if estimate_tokens(para) <= self.chunk_tokens:
+                chunks.append(para)
+                continue
+            # 过长的段落按行合并成不超过 chunk_tokens 的块
+            current = ""
+            for line in para.split("\n"):
+                candidate = (current + "\n" + line) if current else line
+                if current and estimate_tokens(candidate) > self.chunk_tokens:
+                    chunks.append(current)
+                    current = line
+                else:
+                    current = candidate
+            if current.strip():
+                chunks.append(current)
+        return chunks
+
+    def add(self, text):
+        """切块并建立索引，返回新增的块数"""
+        chunks = []
+        for chunk in self._split(text):
+            digest = hashlib.sha1(re.sub(r"\s+", " ", chunk).encode("utf-8")).hexdigest()
+            if digest not in self._hashes:
+                self._hashes.add(digest)
+                chunks.append(chunk)
+        if chunks:
+            vectors = self.embed_model.get_text_embedding_batch(chunks)
+            self.chunks.extend(
+                {"text": c, "vector": v, "tokens": estimate_tokens(c)}
+                for c, v in zip(chunks, vectors)
+            )
+        return len(chunks)
+
+    @staticmethod
+    def _similarity(a, b):
+        dot = sum(x * y for x, y in zip(a, b))
+        norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+        return dot / norm if norm else 0.0
+
+    def select(self, query):
+        """返回与 query 最相关的知识文本"""
+        if not self.chunks:
+            return ""
+        if sum(c["tokens"] for c in self.chunks) <= self.token_budget:
+            selected = self.chunks
+        else:
+            vector = self.embed_model.get_query_embedding(query)
+            ranked = sorted(
+                self.chunks, key=lambda c: self._similarity(vector, c["vector"]), reverse=True
+            )
+            selected, tokens = [], 0
+            for chunk in ranked[: self.top_k]:
+                if selected and tokens + chunk["tokens"] > self.token_budget:
+                    break
+                selected.append(chunk)
+                tokens += chunk["tokens"]
+            # 保持知识在原文中的顺序
+            selected = [c for c in self.chunks if any(c is s for s in selected)]
+        return "\n\n[秘密知识/规则]:\n" + "\n\n".join(c["text"] for c in selected)
+
+    def abstract(self):
+        return {"chunks": len(self.chunks), "tokens": sum(c["tokens"] for c in self.chunks)}
+
+
 class LanguageEmergenceChat:
     """
     语言涌现对话实验类
@@ -45,7 +189,7 @@ class LanguageEmergenceChat:
     
     def __init__(self, name, static_root, checkpoints_folder, config, 
                  novlang_rules=None, start_round=0, verbose="info", turns_per_round=5,
-                 group_chat_interval=3):
+                 group_chat_interval=3, history_config=None, knowledge_config=None):
         self.name = name
         self.static_root = static_root
         self.checkpoints_folder = checkpoints_folder
@@ -54,6 +198,10 @@ class LanguageEmergenceChat:
         self.start_round = start_round
         self.turns_per_round = turns_per_round
         self.group_chat_interval = group_chat_interval
+        # 对话历史窗口配置 {keep_turns, summary_every, token_budget}
+        self.history_config = history_config or {}
+        # 注入知识的检索配置 {top_k, token_budget, chunk_tokens}
+        self.knowledge_config = knowledge_config or {}
         
         os.makedirs(checkpoints_folder, exist_ok=True)
         
@@ -100,7 +248,7 @@ class LanguageEmergenceChat:
 
         # 特殊指令字典
         self.special_instructions = {}
-        # 知识库字典 {agent_name: knowledge_text}
+        # 知识库字典 {agent_name: KnowledgeStore}
         self.agent_knowledge = {}
 
     def set_agent_instruction(self, agent_name, instruction):
@@ -114,9 +262,19 @@ class LanguageEmergenceChat:
             agent_names = [agent_names]
         for name in agent_names:
             if name not in self.agent_knowledge:
-                self.agent_knowledge[name] = ""
-            self.agent_knowledge[name] += f"\n\n[新增秘密知识/规则]:\n{knowledge_text}"
-            self.logger.info(f"已为 {name} 注入新知识 (长度: {len(knowledge_text)})")
+                embed_model = self.game.get_agent(name).associate.index.embed_model
+                self.agent_knowledge[name] = KnowledgeStore(embed_model, **self.knowledge_config)
+            added = self.agent_knowledge[name].add(knowledge_text)
+            self.logger.info(
+                f"已为 {name} 注入新知识 (长度: {len(knowledge_text)}, 新增 {added} 块)"
+            )
+
+    def _select_knowledge(self, agent_name, scene_context, last_utterance=""):
+        """取出与当前场景和上一句话相关的知识"""
+        store = self.agent_knowledge.get(agent_name)
+        if not store:
+            return ""
+        return store.select(scene_context + "\n" + last_utterance)
     
     def _get_scene_context(self, agent1, agent2):
         """获取当前场景描述"""
@@ -132,13 +290,13 @@ class LanguageEmergenceChat:
 """
         return scene.strip()
     
-    def _format_conversation_history(self, conversation_list):
+    def _format_conversation_history(self, conversation_list, summary="", start=1):
         """格式化对话历史（用于理解验证）"""
-        if not conversation_list:
+        if not conversation_list and not summary:
             return "[对话尚未开始]"
         
-        lines = []
-        for i, entry in enumerate(conversation_list, 1):
+        lines = [f"[之前对话摘要] {summary}"] if summary else []
+        for i, entry in enumerate(conversation_list, start):
             speaker = entry.get("speaker", "")
             novlang = entry.get("novlang", "")
             chinese = entry.get("chinese", "")
@@ -146,6 +304,31 @@ class LanguageEmergenceChat:
             lines.append(f"    中文含义: {chinese}")
         return "\n".join(lines)
     
+    @staticmethod
+    def _visible_text(entry):
+        """对话双方都能看到的内容：Novlang 和听者的理解"""
+        text = entry.get("novlang", "")
+        if entry.get("listener_understanding"):
+            text += f"（{entry['listener_understanding']}）"
+        return text
+
+    def _summarize_history(self, agent):
+        """用 agent 的 LLM 把旧回合合并进摘要，与 generate_chat 一样只使用 Novlang，不泄露中文含义"""
+        def _summarize(summary, entries):
+            chats = [(e["speaker"], e.get("novlang", "")) for e in entries]
+            return agent.completion("summarize_history", summary, chats)
+
+        return _summarize
+
+    def _window_chats(self, window, recent):
+        """generate_chat 使用的对话历史：摘要 + 最近的回合"""
+        raw_chats = [("之前对话摘要", window.summary)] if window.summary else []
+        raw_chats.extend(
+            (e["speaker"], {"novlang": e["novlang"], "chinese": e["chinese"]})
+            for e in recent
+        )
+        return raw_chats
+
     def run_conversation_rounds(self, num_rounds):
         """运行多轮对话实验"""
         timer = utils.get_timer()
@@ -202,6 +385,7 @@ class LanguageEmergenceChat:
         情境: 所有人聚在一起，分享之前的发现和想法。
         """
         conversation_history = []
+        window = ConversationWindow(**self.history_config)
         group_listener = GroupListener("大家")
         
         # 获取所有参与者对象
@@ -216,15 +400,14 @@ class LanguageEmergenceChat:
             speaker = participants[turn % len(participants)]
             self.logger.info(f"\n--- 群聊回合 {turn + 1}/{self.turns_per_round} ({speaker.name} 对大家说) ---")
             
-            # 准备对话历史
-            raw_chats = [
-                (e["speaker"], {"novlang": e["novlang"], "chinese": e["chinese"]}) 
-                for e in conversation_history
-            ]
+            # 准备对话历史（旧回合折叠为摘要）
+            recent = window.update(conversation_history, self._summarize_history(speaker))
+            raw_chats = self._window_chats(window, recent)
             
             # 注入指令
             speaker_instruction = self.special_instructions.get(speaker.name, "")
-            speaker_knowledge = self.agent_knowledge.get(speaker.name, "")
+            last_utterance = self._visible_text(recent[-1]) if recent else ""
+            speaker_knowledge = self._select_knowledge(speaker.name, scene_context, last_utterance)
             speaker_context = scene_context
             
             if speaker_knowledge:
@@ -286,6 +469,9 @@ class LanguageEmergenceChat:
             "participants": self.agents,
             "scene": scene_context,
             "conversations": conversation_history,
+            "llm": self._llm_summary(),
+            "history": window.abstract(),
+            "knowledge": {n: k.abstract() for n, k in self.agent_knowledge.items()},
         }
 
     def _run_multi_turn_conversation(self, agent1, agent2, round_num, timer):
@@ -300,6 +486,7 @@ class LanguageEmergenceChat:
         scene_context = self._get_scene_context(agent1, agent2)
         conversation_history = []
         understanding_records = []
+        window = ConversationWindow(**self.history_config)
         
         # 当前说话者和听者
         speaker, listener = agent1, agent2
@@ -313,15 +500,14 @@ class LanguageEmergenceChat:
             # ===== 步骤1：说话者生成内容 =====
             self.logger.info(f"\n[{speaker.name} 思考中...]")
             
-            # 准备对话历史（包含novlang和chinese翻译）
-            raw_chats = [
-                (e["speaker"], {"novlang": e["novlang"], "chinese": e["chinese"]}) 
-                for e in conversation_history
-            ]
+            # 准备对话历史（包含novlang和chinese翻译，旧回合折叠为摘要）
+            recent = window.update(conversation_history, self._summarize_history(speaker))
+            raw_chats = self._window_chats(window, recent)
             
             # 注入特殊指令
             speaker_instruction = self.special_instructions.get(speaker.name, "")
-            speaker_knowledge = self.agent_knowledge.get(speaker.name, "")
+            last_utterance = self._visible_text(recent[-1]) if recent else ""
+            speaker_knowledge = self._select_knowledge(speaker.name, scene_context, last_utterance)
             speaker_context = scene_context
             
             if speaker_knowledge:
@@ -387,7 +573,9 @@ class LanguageEmergenceChat:
 
                 # 注入听者指令和知识
                 listener_instruction = self.special_instructions.get(listener.name, "")
-                listener_knowledge = self.agent_knowledge.get(listener.name, "")
+                listener_knowledge = self._select_knowledge(
+                    listener.name, scene_context, current_novlang
+                )
                 listener_context = scene_context
                 
                 if listener_knowledge:
@@ -402,7 +590,9 @@ class LanguageEmergenceChat:
                         speaker.name,
                         current_novlang, # 听到的内容
                         listener_context + retry_context, # 注入指令和重试提示
-                        self._format_conversation_history(conversation_history)
+                        self._format_conversation_history(
+                            recent, window.summary, window.folded + 1
+                        )
                     )
                     
                     listener_understanding = understand_response.get("my_understanding", "")
@@ -507,8 +697,19 @@ class LanguageEmergenceChat:
             "scene": scene_context,
             "conversations": conversation_history,
             "understanding_records": understanding_records,
+            "llm": self._llm_summary(),
+            "history": window.abstract(),
+            "knowledge": {n: k.abstract() for n, k in self.agent_knowledge.items()},
         }
     
+    def _llm_summary(self):
+        """各Agent的LLM调用统计（累计值：请求数、耗时分位数、token数）"""
+        return {
+            name: agent._llm.get_summary()
+            for name, agent in self.game.agents.items()
+            if agent.llm_available()
+        }
+
     def _save_progress(self, current_round):
         """保存实验进度"""
         # 保存轮次数据
@@ -572,6 +773,7 @@ def get_chat_config(start_time="20240213-10:00", agents=None):
     config = {
         "stride": 5,  # 每次对话推进5分钟
         "time": {"start": start_time},
+        "retry_budget": json_data.get("retry_budget", -1),
         "maze": {"path": os.path.join(assets_root, "maze.json")},
         "agent_base": agent_config,
         "agents": {},
@@ -607,6 +809,11 @@ if __name__ == "__main__":
     parser.add_argument("--novlang-file", type=str, default="", help="新语言规则文件路径")
     parser.add_argument("--verbose", type=str, default="info", help="日志级别")
     parser.add_argument("--group-interval", type=int, default=3, help="多人共享对话频率（每多少轮一次）")
+    parser.add_argument("--history-keep", type=int, default=6, help="对话历史中保留原文的最近回合数")
+    parser.add_argument("--history-summary-every", type=int, default=4, help="每累计多少个旧回合更新一次摘要")
+    parser.add_argument("--history-budget", type=int, default=1200, help="对话历史的token预算（0表示不限制）")
+    parser.add_argument("--knowledge-topk", type=int, default=3, help="每次注入上下文的相关知识块数")
+    parser.add_argument("--knowledge-budget", type=int, default=400, help="注入知识的token上限")
     parser.add_argument("--inject-round", type=int, default=0, help="在第几轮注入额外知识（0表示不注入）")
     # 使用跨平台默认路径（正斜杠），并在解析后统一转为绝对路径
     parser.add_argument("--additional-novlang", type=str, default="data/prompts/additional_novlang.txt", help="额外知识文件路径")
@@ -665,7 +872,16 @@ if __name__ == "__main__":
         start_round=start_round,
         verbose=args.verbose,
         turns_per_round=args.turns,
-        group_chat_interval=args.group_interval
+        group_chat_interval=args.group_interval,
+        history_config={
+            "keep_turns": args.history_keep,
+            "summary_every": args.history_summary_every,
+            "token_budget": args.history_budget,
+        },
+        knowledge_config={
+            "top_k": args.knowledge_topk,
+            "token_budget": args.knowledge_budget,
+        },
     )
     
     # 运行实验
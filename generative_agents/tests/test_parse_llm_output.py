@@ -0,0 +1,27 @@
+"""Tests of the line prefilter in parse_llm_output"""
+
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.model.llm_model import _literal_prefix, parse_llm_output
+
+
+def test_literal_prefix():
+    assert _literal_prefix("评分[:：]\\s*(\\d+)") == (False, "评分")
+    assert _literal_prefix("^\\[(\\d{2}:\\d{2})\\]") == (True, "[")
+
+
+def test_top_level_alternation_disables_prefilter():
+    assert _literal_prefix("foo|bar") == (False, "")
+    assert _literal_prefix("^foo|bar") == (False, "")
+    assert parse_llm_output("bar 1", ["foo|bar"]) == re.findall("foo|bar", "bar 1")[0]
+    assert parse_llm_output("x bar", ["^foo|bar"]) == "bar"
+
+
+def test_alternation_inside_group_keeps_prefix():
+    assert _literal_prefix("评分(是|否)") == (False, "评分")
+    assert _literal_prefix("ab[|]c") == (False, "ab")
+    assert parse_llm_output("评分否", ["评分(是|否)"]) == "否"